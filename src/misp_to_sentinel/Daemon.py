@@ -0,0 +1,146 @@
+import hmac
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import config
+
+ZMQ_TOPICS = ('misp_json', 'misp_json_attribute')
+
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        authorization = self.headers.get('Authorization', '').encode('utf-8')
+        if not hmac.compare_digest(authorization, config.webhook_token.encode('utf-8')):
+            self._reply(401)
+            return
+        try:
+            message = json.loads(body)
+        except json.decoder.JSONDecodeError:
+            self._reply(400)
+            return
+        self.server.daemon.put(message)
+        self._reply(202)
+
+    def _reply(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class Daemon:
+    """A class that keeps the sync resident instead of starting it from cron
+
+    Full syncs, with their cleanups, run on a schedule. In between, events and
+    attributes pushed by misp over its ZeroMQ feed or a webhook are collected
+    into micro-batches and handed to push, so they reach Graph within seconds
+    in a process that already holds its imports, tokens and connections.
+    Jobs run one at a time, a full sync never races a push over the state.
+
+    to use the class:
+        daemon = Daemon(sync, push)
+        daemon.run()
+
+    sync is called without arguments, push with a list of pushed messages,
+    each the json misp sent. A pushed message is only a hint which event
+    changed, push is expected to fetch the event from misp itself.
+    """
+
+    def __init__(self, sync, push, sync_interval=None, batch_size=None, batch_wait=None):
+        self.sync = sync
+        self.push = push
+        self.sync_interval = config.daemon_sync_interval if sync_interval is None else sync_interval
+        self.batch_size = batch_size or config.push_batch_size
+        self.batch_wait = config.push_batch_wait if batch_wait is None else batch_wait
+        self.messages = queue.Queue()
+        self.stopping = threading.Event()
+        self.webhook_server = None
+
+    def put(self, message):
+        self.messages.put(message)
+
+    def stop(self):
+        self.stopping.set()
+
+    def run(self):
+        if config.webhook_port and not config.webhook_token:
+            # anyone reaching the port could otherwise plant indicators in every tenant
+            raise ValueError('WEBHOOK_PORT is set without WEBHOOK_TOKEN')
+        if config.misp_zmq_url:
+            threading.Thread(target=self._listen_zmq, args=(config.misp_zmq_url,), name='zmq', daemon=True).start()
+        if config.webhook_port:
+            self.webhook_server = ThreadingHTTPServer((config.webhook_host, config.webhook_port), _WebhookHandler)
+            self.webhook_server.daemon_threads = True
+            self.webhook_server.daemon = self
+            threading.Thread(target=self.webhook_server.serve_forever, name='webhook', daemon=True).start()
+        next_sync = time.monotonic()
+        try:
+            while not self.stopping.is_set():
+                if time.monotonic() >= next_sync:
+                    self._run_job('sync', self.sync)
+                    # a sync running over its interval skips the missed ones
+                    next_sync = max(next_sync + self.sync_interval, time.monotonic())
+                batch = self._get_batch(next_sync)
+                if batch:
+                    self._run_job('push', self.push, batch)
+        finally:
+            if self.webhook_server is not None:
+                self.webhook_server.shutdown()
+
+    def _run_job(self, name, job, *args):
+        start = time.monotonic()
+        try:
+            job(*args)
+        except Exception as e:
+            # the daemon stays up, the next run retries
+            print(f'{name} failed: {e}', flush=True)
+        print(json.dumps({'report': 'job', 'job': name, 'seconds': round(time.monotonic() - start, 2)}), flush=True)
+
+    def _get_batch(self, deadline):
+        """Waits until deadline for a first message, then up to batch_wait for more."""
+        batch = []
+        while not batch:
+            # wakes up regularly so stop is noticed
+            timeout = min(1.0, deadline - time.monotonic())
+            if timeout <= 0 or self.stopping.is_set():
+                return batch
+            try:
+                batch.append(self.messages.get(timeout=timeout))
+            except queue.Empty:
+                pass
+        batch_deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            timeout = batch_deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.messages.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _listen_zmq(self, url):
+        # only needed with a zeromq feed configured
+        import zmq
+
+        socket = zmq.Context.instance().socket(zmq.SUB)
+        socket.connect(url)
+        for topic in ZMQ_TOPICS:
+            socket.setsockopt_string(zmq.SUBSCRIBE, topic)
+        while True:
+            # misp sends '<topic> <json>' as a single frame
+            topic, _, payload = socket.recv_string().partition(' ')
+            if topic not in ZMQ_TOPICS:
+                continue
+            try:
+                self.put(json.loads(payload))
+            except json.decoder.JSONDecodeError as e:
+                print(f'skipping malformed {topic} message: {e}', flush=True)
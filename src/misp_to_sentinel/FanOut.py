@@ -0,0 +1,112 @@
+import queue
+import threading
+from concurrent.futures import Future
+
+import config
+from RequestManager import RequestManager
+from RunReport import run_report
+
+
+class FanOutAborted(Exception):
+    pass
+
+
+class FanOut:
+    """A class that submits a single parsed misp stream to every target tenant at once
+
+    Each target is served by a thread with a RequestManager of its own, and so
+    its own state store, token provider and Graph session. Parsed events are
+    queued to all of them, misp is fetched and parsed once however many
+    tenants there are. The queues are bounded, the stream runs no further
+    ahead than the slowest tenant allows. A failing target does not stop
+    the others, it is reported when the fan out ends.
+
+    to use the class:
+        with FanOut(get_targets()) as fan_out:
+            for event_id, timestamp, request_bodies in parsed_events:
+                fan_out.put(event_id, timestamp, request_bodies)
+
+    """
+
+    QUEUE_SIZE = 100
+
+    _STOP = object()
+    _ABORT = object()
+
+    def __init__(self, targets, reconcile=False, partial=False):
+        self.targets = targets
+        self.reconcile = reconcile
+        self.partial = partial
+        self.queues = [queue.Queue(self.QUEUE_SIZE) for _ in targets]
+        self.threads = []
+        self.failures = {}
+        self.high_water_mark = None
+
+    def __enter__(self):
+        started = []
+        for target, events in zip(self.targets, self.queues):
+            ready = Future()
+            thread = threading.Thread(target=self._run, args=(target, events, ready), name=f'target-{target}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+            started.append(ready)
+        high_water_marks = []
+        for ready in started:
+            try:
+                high_water_marks.append(ready.result())
+            except Exception:
+                # recorded in failures, the other targets go ahead
+                pass
+        if len(self.failures) == len(self.targets):
+            self.__exit__(None, None, None)
+        # a target without a mark needs all of misp, the others skip what they already have
+        if high_water_marks and None not in high_water_marks:
+            self.high_water_mark = min(int(mark) for mark in high_water_marks)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # an interrupted stream must not let any target delete what it did not get to see
+        end = self._STOP if exc_type is None else self._ABORT
+        for events in self.queues:
+            events.put(end)
+        for thread in self.threads:
+            thread.join()
+        if self.failures and exc_type is None:
+            failed = ', '.join(f'{target}: {error}' for target, error in self.failures.items())
+            raise RuntimeError(f'{len(self.failures)} of {len(self.targets)} targets failed, {failed}')
+
+    def put(self, event_id, timestamp, request_bodies):
+        for events in self.queues:
+            events.put((event_id, timestamp, request_bodies))
+
+    def _run(self, target, events, ready):
+        ended = False
+        try:
+            with RequestManager(reconcile=self.reconcile, target=target, partial=self.partial) as request_manager:
+                ready.set_result(
+                    request_manager.state.get_meta('misp_high_water_mark') if config.misp_incremental else None)
+                while True:
+                    item = events.get()
+                    ended = item is self._STOP or item is self._ABORT
+                    if item is self._STOP:
+                        return
+                    if item is self._ABORT:
+                        # leaves the request manager with an exception, so it deletes nothing
+                        raise FanOutAborted()
+                    event_id, timestamp, request_bodies = item
+                    request_manager.handle_event(event_id, timestamp)
+                    # includes the posts the indicators wait for
+                    with run_report.time('handle_indicator'):
+                        for request_body in request_bodies:
+                            request_manager.handle_indicator(request_body, event_id)
+        except FanOutAborted:
+            pass
+        except Exception as e:
+            print(f'target {target} failed: {e}')
+            self.failures[str(target)] = e
+            if not ready.done():
+                ready.set_exception(e)
+            # keep taking events so the stream is never blocked on this target
+            while not ended:
+                item = events.get()
+                ended = item is self._STOP or item is self._ABORT
@@ -0,0 +1,153 @@
+import gzip
+import json
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import config
+
+RETRY_STATUS_CODES = frozenset([429, 502, 503, 504])
+THROTTLE_STATUS_CODES = frozenset([429, 503])
+
+
+class GraphSession(requests.Session):
+    """A requests session that retries throttled and failed calls to Graph.
+
+    Retry-After is honored and otherwise jittered exponential backoff is used.
+    Throttling halves the number of concurrent requests and spaces out new ones,
+    successful requests slowly restore both. Connections are kept alive in a
+    pool, every call gets a timeout and json bodies can be gzipped, whether
+    passed as json or as data already serialized with a json Content-Type.
+    A call made with idempotent=False is only retried when it surely was not
+    processed, after throttling or a connection that was never made.
+
+    to use the class:
+        response = graph_session.post(url, headers=headers, json=request_body)
+
+    """
+
+    MAX_INTERVAL = 5.0
+
+    _tenant_sessions = {}
+    _tenant_sessions_lock = threading.Lock()
+
+    def __init__(self, max_concurrency, gzip_json=False):
+        super().__init__()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config.http_pool_size)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+        self.gzip_json = gzip_json
+        self.max_concurrency = max_concurrency
+        self.concurrency = max_concurrency
+        self.interval = 0.0
+        self.in_flight = 0
+        self.not_before = 0.0
+        self.condition = threading.Condition()
+        self.request_count = 0
+        self.retry_count = 0
+        self.throttle_count = 0
+        self.wait_seconds = 0.0
+
+    @classmethod
+    def for_tenant(cls, tenant):
+        """Returns the session of a tenant, kept for the life of the process.
+
+        Throttling is per tenant, and a resident process keeps both its
+        connections and what it learned about the throttling across runs.
+        """
+        with cls._tenant_sessions_lock:
+            if tenant not in cls._tenant_sessions:
+                cls._tenant_sessions[tenant] = cls(config.graph_max_in_flight, gzip_json=config.graph_gzip)
+            return cls._tenant_sessions[tenant]
+
+    def request(self, method, url, *args, idempotent=True, **kwargs):
+        kwargs.setdefault('timeout', config.http_timeout)
+        if self.gzip_json and kwargs.get('json') is not None:
+            kwargs['data'] = json.dumps(kwargs.pop('json')).encode('utf-8')
+            kwargs['headers'] = {**(kwargs.get('headers') or {}), 'Content-Type': 'application/json'}
+        # json serialized by the caller is compressed as well
+        if self.gzip_json and kwargs.get('data') and (kwargs.get('headers') or {}).get('Content-Type') == 'application/json':
+            kwargs['data'] = gzip.compress(kwargs['data'])
+            kwargs['headers'] = {**kwargs['headers'], 'Content-Encoding': 'gzip'}
+        for attempt in range(config.graph_max_retries + 1):
+            self._acquire()
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                # a call that timed out or lost its connection may have been processed all the same
+                if attempt == config.graph_max_retries or not (idempotent or isinstance(e, requests.ConnectTimeout)):
+                    raise
+                response = None
+            finally:
+                self._release()
+            retry_status_codes = RETRY_STATUS_CODES if idempotent else THROTTLE_STATUS_CODES
+            if response is not None and response.status_code not in retry_status_codes:
+                self._on_success()
+                return response
+            if attempt == config.graph_max_retries:
+                return response
+            self._on_retry(response, attempt)
+
+    def _acquire(self):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                if self.in_flight < self.concurrency and now >= self.not_before:
+                    break
+                if self.in_flight < self.concurrency:
+                    self.condition.wait(self.not_before - now)
+                else:
+                    self.condition.wait()
+            self.in_flight += 1
+            self.request_count += 1
+            self.not_before = max(self.not_before, now + self.interval)
+
+    def _release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def _on_success(self):
+        with self.condition:
+            if self.concurrency < self.max_concurrency:
+                self.concurrency += 1
+            self.interval /= 2
+            self.condition.notify_all()
+
+    def _on_retry(self, response, attempt):
+        delay = random.uniform(0, min(config.graph_max_backoff, config.graph_base_backoff * 2 ** attempt))
+        throttled = response is not None and response.status_code in THROTTLE_STATUS_CODES
+        if throttled:
+            delay = max(delay, self._get_retry_after(response))
+        with self.condition:
+            self.retry_count += 1
+            self.wait_seconds += delay
+            if throttled:
+                self.throttle_count += 1
+                self.concurrency = max(1, self.concurrency // 2)
+                self.interval = min(self.MAX_INTERVAL, max(0.1, self.interval * 2))
+                # every caller backs off, not only the one that got throttled
+                self.not_before = max(self.not_before, time.monotonic() + delay)
+        time.sleep(delay)
+
+    @staticmethod
+    def _get_retry_after(response):
+        retry_after = response.headers.get('Retry-After')
+        if retry_after is None:
+            return 0.0
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return 0.0
+
+
+graph_session = GraphSession(config.graph_max_in_flight, gzip_json=config.graph_gzip)
+login_session = GraphSession(1)
@@ -0,0 +1,115 @@
+import gzip
+import json
+import os
+import queue
+import threading
+import uuid
+from datetime import datetime
+
+from RunReport import run_report
+
+
+class LogWriter:
+    """A class that writes log records as newline-delimited json from a background thread
+
+    Records are appended to segment files in the log directory. A new segment
+    is started once the current one reaches the segment size, segments can be
+    gzip compressed. Starting one removes the oldest segments of the directory
+    beyond max_segments, so the logs rotate instead of growing without end. Should writing fail, e.g. on a full disk, the error is
+    raised from the next write or from leaving the with block.
+
+    to use the class:
+        with LogWriter(LOG_DIRECTORY_NAME) as log_writer:
+            log_writer.write('error', response['error'])
+
+    """
+
+    _STOP = object()
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024, compress=False, queue_size=10000, max_segments=0):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.compress = compress
+        self.max_segments = max_segments
+        # writers started within the same second, e.g. back to back push jobs, must not share file names
+        self.writer_id = uuid.uuid4().hex[:8]
+        self.records = queue.Queue(queue_size)
+        self.file = None
+        self.file_size = 0
+        self.segment_count = 0
+        self.error = None
+
+    def __enter__(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.error is None:
+            self._put(self._STOP)
+        self.thread.join()
+        # an exception already on its way out is not replaced
+        if self.error is not None and exc_type is None:
+            raise self.error
+
+    def write(self, record_type, data):
+        if self.error is not None:
+            raise self.error
+        self._put({'time': str(datetime.now()), 'type': record_type, 'data': data})
+
+    def _put(self, record):
+        # a full queue drains unless the thread died, which must not block the caller forever
+        while self.error is None:
+            try:
+                self.records.put(record, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def _run(self):
+        try:
+            while True:
+                record = self.records.get()
+                if record is self._STOP:
+                    break
+                with run_report.time('log_write'):
+                    self._write(record)
+        except Exception as e:
+            self.error = e
+        finally:
+            if self.file is not None:
+                self.file.close()
+
+    def _write(self, record):
+        line = (json.dumps(record) + '\n').encode('utf-8')
+        if self.file is None or self.file_size >= self.segment_size:
+            self._open_segment()
+        self.file.write(line)
+        self.file_size += len(line)
+        # write whatever is queued before flushing, so a burst costs one flush
+        if self.records.empty():
+            self.file.flush()
+
+    def _open_segment(self):
+        if self.file is not None:
+            self.file.close()
+        self.segment_count += 1
+        timestamp = datetime.now().strftime('%Y-%m-%d_%H%M%S')
+        file_name = f'{self.directory}/{timestamp}_{self.writer_id}_{self.segment_count:04d}.ndjson'
+        self._remove_old_segments()
+        if self.compress:
+            self.file = gzip.open(f'{file_name}.gz', 'wb')
+        else:
+            self.file = open(file_name, 'wb')
+        self.file_size = 0
+
+    def _remove_old_segments(self):
+        if not self.max_segments:
+            return
+        # names start with their timestamp, so they sort oldest first
+        segments = sorted(
+            name for name in os.listdir(self.directory) if name.endswith('.ndjson') or name.endswith('.ndjson.gz'))
+        # leaves room for the segment about to be opened
+        for name in segments[:max(0, len(segments) - self.max_segments + 1)]:
+            os.remove(os.path.join(self.directory, name))
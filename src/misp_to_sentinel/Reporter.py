@@ -0,0 +1,159 @@
+import json
+import math
+import os
+import sys
+import time
+from collections import deque
+
+import config
+
+LATENCY_QUANTILES = (0.5, 0.9, 0.99)
+
+
+class Reporter:
+    """A class that reports sync progress, subclasses decide where to
+
+    to use the class:
+        reporter = get_reporter()
+        reporter.batch_done(response.elapsed.total_seconds())
+        reporter.progress(stats)
+        reporter.summary(stats)
+
+    stats is a dict of counters: parsed, sent, success, error, updated, deleted,
+    expired, retries, throttles, backoff_seconds and optionally expected,
+    next to the name of the target tenant, None for the AZ_* one.
+    """
+
+    def __init__(self, interval=0.0):
+        self.interval = interval
+        self.start_time = time.monotonic()
+        self.last_report_time = 0.0
+        self.batch_latencies = deque(maxlen=1000)
+
+    def batch_done(self, latency):
+        self.batch_latencies.append(latency)
+
+    def progress(self, stats):
+        now = time.monotonic()
+        if now - self.last_report_time < self.interval:
+            return
+        self.last_report_time = now
+        self._write_progress(self._get_metrics(stats))
+
+    def summary(self, stats):
+        self._write_summary(self._get_metrics(stats))
+
+    def _get_metrics(self, stats):
+        elapsed = time.monotonic() - self.start_time
+        metrics = {**stats, 'elapsed_seconds': round(elapsed, 2)}
+        metrics['throughput'] = round(stats['sent'] / elapsed, 2) if elapsed > 0 else 0.0
+        latencies = sorted(self.batch_latencies)
+        for quantile in LATENCY_QUANTILES:
+            key = f'batch_latency_p{int(quantile * 100)}'
+            metrics[key] = round(latencies[math.ceil(quantile * len(latencies)) - 1], 3) if latencies else None
+        metrics['eta_seconds'] = None
+        if stats.get('expected') and stats['parsed'] > 0:
+            parse_rate = stats['parsed'] / elapsed
+            metrics['eta_seconds'] = round(max(0, stats['expected'] - stats['parsed']) / parse_rate)
+        return metrics
+
+    def _write_progress(self, metrics):
+        raise NotImplementedError
+
+    def _write_summary(self, metrics):
+        raise NotImplementedError
+
+
+class TtyReporter(Reporter):
+    """Redraws a single progress line on an interactive terminal."""
+
+    RJUST = 5
+
+    def _write_progress(self, metrics):
+        line = f"{metrics['target']}: " if metrics['target'] else ''
+        line += (f"parsed {metrics['parsed']}, sent {metrics['sent']}, errors {metrics['error']}, "
+                f"{metrics['throughput']} indicators/s, p90 batch {metrics['batch_latency_p90']}s")
+        if metrics['eta_seconds'] is not None:
+            line += f", eta {metrics['eta_seconds']}s"
+        sys.stdout.write(f'\r\x1b[2K{line}')
+        sys.stdout.flush()
+
+    def _write_summary(self, metrics):
+        print('\n\nscript finished running\n')
+        if metrics['target']:
+            print(f"target:                   {metrics['target']}")
+        print(f"total indicators sent:    {str(metrics['sent']).rjust(self.RJUST)}")
+        print(f"total response success:   {str(metrics['success']).rjust(self.RJUST)}")
+        print(f"total response error:     {str(metrics['error']).rjust(self.RJUST)}")
+        print(f"total indicators updated: {str(metrics['updated']).rjust(self.RJUST)}")
+        print(f"total indicators deleted: {str(metrics['deleted']).rjust(self.RJUST)}")
+        print(f"total expired deleted:    {str(metrics['expired']).rjust(self.RJUST)}")
+        print(f"total graph retries:      {str(metrics['retries']).rjust(self.RJUST)}")
+        print(f"total graph throttles:    {str(metrics['throttles']).rjust(self.RJUST)}")
+        print(f"total backoff seconds:    {str(round(metrics['backoff_seconds'])).rjust(self.RJUST)}")
+
+
+class LogReporter(Reporter):
+    """Prints one json line per report, for containers without a terminal."""
+
+    def _write_progress(self, metrics):
+        print(json.dumps({'report': 'progress', **metrics}), flush=True)
+
+    def _write_summary(self, metrics):
+        print(json.dumps({'report': 'summary', **metrics}), flush=True)
+
+
+class PrometheusReporter(LogReporter):
+    """Logs like LogReporter and keeps a Prometheus textfile collector file up to date."""
+
+    COUNTERS = ('parsed', 'sent', 'success', 'error', 'updated', 'deleted', 'expired', 'retries', 'throttles')
+
+    def __init__(self, file_name, interval=0.0):
+        super().__init__(interval)
+        self.file_name = file_name
+
+    def _write_progress(self, metrics):
+        super()._write_progress(metrics)
+        self._write_textfile(metrics)
+
+    def _write_summary(self, metrics):
+        super()._write_summary(metrics)
+        self._write_textfile(metrics)
+
+    def _write_textfile(self, metrics):
+        lines = []
+        for counter in self.COUNTERS:
+            lines.append(f'# TYPE misp2sentinel_{counter}_total counter')
+            lines.append(f'misp2sentinel_{counter}_total {metrics[counter]}')
+        lines.append('# TYPE misp2sentinel_backoff_seconds_total counter')
+        lines.append(f"misp2sentinel_backoff_seconds_total {metrics['backoff_seconds']}")
+        lines.append('# TYPE misp2sentinel_throughput_per_second gauge')
+        lines.append(f"misp2sentinel_throughput_per_second {metrics['throughput']}")
+        lines.append('# TYPE misp2sentinel_batch_latency_seconds summary')
+        for quantile in LATENCY_QUANTILES:
+            value = metrics[f'batch_latency_p{int(quantile * 100)}']
+            if value is not None:
+                lines.append(f'misp2sentinel_batch_latency_seconds{{quantile="{quantile}"}} {value}')
+        if metrics['eta_seconds'] is not None:
+            lines.append('# TYPE misp2sentinel_eta_seconds gauge')
+            lines.append(f"misp2sentinel_eta_seconds {metrics['eta_seconds']}")
+        # replace the file in one go so a scrape never sees half of it
+        with open(f'{self.file_name}.tmp', 'w') as file:
+            file.write('\n'.join(lines) + '\n')
+        os.replace(f'{self.file_name}.tmp', self.file_name)
+
+
+def get_reporter(target_name=None):
+    reporter = config.reporter
+    if reporter == 'auto':
+        reporter = 'tty' if sys.stdout.isatty() else 'log'
+    if reporter == 'tty':
+        return TtyReporter()
+    if reporter == 'prometheus':
+        file_name = config.prometheus_textfile
+        if target_name:
+            # one textfile per target, misp2sentinel.prom becomes misp2sentinel-<target>.prom
+            root, extension = os.path.splitext(file_name)
+            file_name = f'{root}-{target_name}{extension}'
+        return PrometheusReporter(file_name, config.report_interval)
+    return LogReporter(config.report_interval)
@@ -0,0 +1,69 @@
+class RequestBatch:
+    """A class that collects serialized items into a single {"value": [...]} request body
+
+    Items are json already encoded to bytes, each is copied once into a buffer
+    the batch keeps for its whole life. A batch is full at max_count items or
+    when the next item would take the body past max_bytes, an item larger than
+    max_bytes on its own still gets a batch of its own. Every item can carry a
+    key, e.g. its fingerprint, to find what was sent when the response comes.
+
+    to use the class:
+        batch = RequestBatch(100, 1024 * 1024)
+        if not batch.fits(item):
+            post(*batch.take())
+        batch.add(item, key)
+
+    """
+
+    PREFIX = b'{"value":['
+    SUFFIX = b']}'
+
+    def __init__(self, max_count, max_bytes):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.buffer = bytearray(self.PREFIX)
+        # (start, end) of every item in the body
+        self.offsets = []
+        self.keys = []
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @property
+    def size(self):
+        return len(self.buffer) + len(self.SUFFIX)
+
+    def fits(self, item):
+        if not self.offsets:
+            return True
+        return len(self.offsets) < self.max_count and self.size + 1 + len(item) <= self.max_bytes
+
+    def add(self, item, key=None):
+        if self.offsets:
+            self.buffer += b','
+        start = len(self.buffer)
+        self.buffer += item
+        self.offsets.append((start, len(self.buffer)))
+        self.keys.append(key)
+
+    def take(self):
+        """Returns the request body, the offsets and the keys of its items, the batch starts over empty."""
+        self.buffer += self.SUFFIX
+        body = bytes(self.buffer)
+        offsets, keys = self.offsets, self.keys
+        # keeps the allocation for the next batch
+        del self.buffer[len(self.PREFIX):]
+        self.offsets, self.keys = [], []
+        return body, offsets, keys
+
+    @classmethod
+    def split(cls, body, offsets, keys):
+        """Returns the request bodies, offsets and keys of the two halves of a taken batch."""
+        middle = len(offsets) // 2
+        halves = []
+        for half_offsets, half_keys in ((offsets[:middle], keys[:middle]), (offsets[middle:], keys[middle:])):
+            batch = cls(len(half_offsets), len(body))
+            for (start, end), key in zip(half_offsets, half_keys):
+                batch.add(body[start:end], key)
+            halves.append(batch.take())
+        return halves
@@ -1,189 +1,259 @@
 import requests
 import config
-import datetime
-import os
 import json
-import copy
+from collections import defaultdict, deque
+from itertools import islice
+from requests_futures.sessions import FuturesSession
+from GraphSession import GraphSession, graph_session
+from TokenProvider import TokenProvider
 from constants import *
-import dateutil
-from datetime import datetime
+from fingerprint import get_fingerprint, get_identity
+from StateStore import StateStore
+from LogWriter import LogWriter
+from Reporter import get_reporter
+from RunReport import run_report
+from RequestBatch import RequestBatch
+from Target import Target
+from datetime import datetime, timedelta
 
 class RequestManager:
     """A class that handles submitting TiIndicators to MS Graph Security API
 
+    Every target tenant gets a RequestManager of its own, the one without a
+    target submits to the tenant configured by the AZ_* settings. Indicators
+    that changed since they were submitted are updated in place. A partial
+    one only submits what it is handed, for events pushed by misp between
+    full runs, and leaves deleting to the next full run.
+
     to use the class:
         with RequestManager() as request_manager:
             request_manager.handle_indicator(tiindicator)
 
     """
 
-    RJUST = 5
-
-    def __init__(self, total_indicators):
-        self.total_indicators = total_indicators
+    def __init__(self, expected_indicators=None, reconcile=False, target=None, partial=False):
+        self.expected_indicators = expected_indicators
+        self.reconcile = reconcile
+        self.partial = partial
+        self.target = target or Target.from_config()
+        self.total_indicators = 0
 
     def __enter__(self):
-        try:
-            self.existing_indicators_hash_fd = open(EXISTING_INDICATORS_HASH_FILE_NAME, 'r+')
-            self.existing_indicators_hash = json.load(self.existing_indicators_hash_fd)
-        except (FileNotFoundError, json.decoder.JSONDecodeError):
-            self.existing_indicators_hash_fd = open(EXISTING_INDICATORS_HASH_FILE_NAME, 'w')
-            self.existing_indicators_hash = {}
-        try:
-            self.expiration_date_fd = open(EXPIRATION_DATE_FILE_NAME, 'r+')
-            self.expiration_date = self.expiration_date_fd.read()
-        except FileNotFoundError:
-            self.expiration_date_fd = open(EXPIRATION_DATE_FILE_NAME, 'w')
-            self.expiration_date = self._get_expiration_date_from_config()
-        if self.expiration_date <= datetime.utcnow().strftime('%Y-%m-%d'):
-            self.existing_indicators_hash = {}
-            self.expiration_date = self._get_expiration_date_from_config()
-        self.hash_of_indicators_to_delete = copy.deepcopy(self.existing_indicators_hash)
-        #print(f"hash of indicators to delete {self.hash_of_indicators_to_delete}")
-        access_token = self._get_access_token(
-            config.graph_auth[TENANT],
-            config.graph_auth[CLIENT_ID],
-            config.graph_auth[CLIENT_SECRET])
-        self.headers = {"Authorization": f"Bearer {access_token}", 'user-agent': 'MISP/1.0'}
-        self.headers_expiration_time = self._get_timestamp() + 3500
+        self.state = StateStore(self.target.state_file_name).__enter__()
+        # the json state of older versions belongs to the AZ_* tenant
+        if self.target.name is None:
+            self.state.migrate_json(EXISTING_INDICATORS_HASH_FILE_NAME, EXPIRATION_DATE_FILE_NAME)
+        if self.partial:
+            self.state.join_run()
+            # clearing the state on expiry is up to the next full run
+            self.expiration_date = self.state.get_meta('expiration_date', '')
+            if self.expiration_date <= datetime.utcnow().strftime('%Y-%m-%d'):
+                self.expiration_date = self._get_expiration_date_from_config()
+        else:
+            self.state.start_run()
+            if self.expected_indicators is None and not config.misp_incremental:
+                # a full run parses about as many indicators as the one before, which gives the eta
+                indicators_parsed = self.state.get_meta('indicators_parsed')
+                self.expected_indicators = int(indicators_parsed) if indicators_parsed else None
+            self.expiration_date = self.state.get_meta('expiration_date') or self._get_expiration_date_from_config()
+            if self.expiration_date <= datetime.utcnow().strftime('%Y-%m-%d'):
+                self.state.clear()
+                self.expiration_date = self._get_expiration_date_from_config()
+            self.state.set_meta('expiration_date', self.expiration_date)
+            self.state.commit()
+        self.token_provider = TokenProvider.get(self.target.tenant, self.target.client_id, self.target.client_secret)
         self.success_count = 0
         self.error_count = 0
         self.del_count = 0
-        self.indicators_to_be_sent = []
-        self.indicators_to_be_sent_size = 0
-        self.start_time = self.last_batch_done_timestamp = self._get_timestamp()
-        if not os.path.exists(LOG_DIRECTORY_NAME):
-            os.makedirs(LOG_DIRECTORY_NAME)
+        self.expired_count = 0
+        self.update_count = 0
+        # indicators are serialized once, into the batch that is posted as is
+        self.submission_batch = RequestBatch(config.graph_batch_size, config.graph_batch_bytes)
+        # fingerprint -> (event id, identity, serialized indicator) of submissions awaiting their response
+        self.submissions_in_flight = {}
+        self.update_batch = RequestBatch(config.graph_batch_size, config.graph_batch_bytes)
+        # Graph id -> (old fingerprint, event id, indicator) of updates awaiting their response
+        self.updates_in_flight = {}
+        self.high_water_mark = int(self.state.get_meta('misp_high_water_mark', 0))
+        # event id -> misp timestamp of the events seen this run
+        self.event_timestamps = {}
+        # timestamp of the earliest event with an indicator that failed, 0 when that event is unknown
+        self.earliest_failed_timestamp = None
+        self.graph_session = GraphSession.for_tenant(self.target.tenant)
+        # the session outlives the run, its counters are reported relative to now
+        self.graph_session_counts = self._get_graph_session_counts()
+        self.session = FuturesSession(session=self.graph_session, max_workers=config.graph_max_in_flight)
+        self.posts_in_flight = deque()
+        self.reporter = get_reporter(self.target.name)
+        self.log_writer = LogWriter(
+            self.target.log_directory_name,
+            segment_size=config.log_segment_size,
+            compress=config.log_compress,
+            max_segments=config.log_max_segments,
+        ).__enter__()
+        if self.reconcile:
+            with run_report.time('reconcile'):
+                self._reconcile_state()
         return self
 
-    @staticmethod
-    def _get_expiration_date_from_config():
-        return (datetime.utcnow() + datetime.timedelta(config.days_to_expire)).strftime('%Y-%m-%d')
+    def _get_expiration_date_from_config(self):
+        return (datetime.utcnow() + timedelta(self.target.days_to_expire)).strftime('%Y-%m-%d')
 
-    @staticmethod
-    def _get_access_token(tenant, client_id, client_secret):
-        data = {
-            CLIENT_ID: client_id,
-            'scope': 'https://graph.microsoft.com/.default',
-            CLIENT_SECRET: client_secret,
-            'grant_type': 'client_credentials'
-        }
-        access_token = requests.post(
-            f'https://login.microsoftonline.com/{tenant}/oauth2/v2.0/token',
-            data=data
-        ).json()[ACCESS_TOKEN]
-        return access_token
+    @property
+    def headers(self):
+        return self.token_provider.get_headers()
 
     @staticmethod
-    def read_tiindicators():
-        access_token = RequestManager._get_access_token(
-            config.graph_auth[TENANT],
-            config.graph_auth[CLIENT_ID],
-            config.graph_auth[CLIENT_SECRET])
-        print(json.dumps(requests.get(
+    def read_tiindicators(target=None):
+        target = target or Target.from_config()
+        print(json.dumps(graph_session.get(
             GRAPH_TI_INDICATORS_URL,
-            headers={"Authorization": f"Bearer {access_token}"}
+            headers=TokenProvider.get(target.tenant, target.client_id, target.client_secret).get_headers()
             ).json(), indent=2))
 
     @staticmethod
     def _get_request_hash(request):
-        return str(hash(frozenset({
-            k: str(v) for k, v in request.items()
-            if k != 'expirationDateTime' and k != 'lastReportedDateTime'
-        }.items())))
-
-    def _log_post(self, response):
-        self._clear_screen()
-        cur_batch_success_count = cur_batch_error_count = 0
+        return get_fingerprint(request)
+
+    def _log_post(self, response, fingerprints):
         #print(f"response: {response}")
         if 'error' in response:
             self.error_count += 1
-            cur_batch_error_count += 1
-            file_name = f"{self._get_datetime_now()}_error.json"
-            log_file_name = file_name.replace(':', '')
-            with open(f'{LOG_DIRECTORY_NAME}/{log_file_name}', 'w') as file:
-                json.dump(response['error'], file)
+            self.log_writer.write('error', response['error'])
+            for fingerprint in fingerprints:
+                if fingerprint in self.submissions_in_flight:
+                    self._mark_failed(self.submissions_in_flight[fingerprint][0])
         else:
             if len(response['value']) > 0:
                 for value in response['value']:
+                    event_id, identity, serialized = self.submissions_in_flight.pop(
+                        value[INDICATOR_REQUEST_HASH], (None, None, None))
                     if "Error" in value:
                         self.error_count += 1
-                        cur_batch_error_count += 1
-                        file_name = f"{self._get_datetime_now()}_error_{value[INDICATOR_REQUEST_HASH]}.json"
-                        log_file_name = file_name.replace(':', '')
+                        self.log_writer.write('error', value)
+                        self._mark_failed(event_id)
                     else:
                         self.success_count += 1
-                        cur_batch_success_count += 1
-                        self.existing_indicators_hash[value[INDICATOR_REQUEST_HASH]] = value['id']
-                        # if not config.verbose_log:
-                        #     continue
-                        file_name = f"{self._get_datetime_now()}_{value[INDICATOR_REQUEST_HASH]}.json"
-                        log_file_name = file_name.replace(':', '')
-                    with open(f'{LOG_DIRECTORY_NAME}/{log_file_name}', 'w') as file:
-                        json.dump(value, file)
+                        self.state.add(value[INDICATOR_REQUEST_HASH], value['id'], event_id, identity, serialized)
+                        if config.verbose_log:
+                            self.log_writer.write('success', value)
             else: 
-                file_name = f"{self._get_datetime_now()}.json"
-                log_file_name = file_name.replace(':', '')
-                with open(f'{LOG_DIRECTORY_NAME}/{log_file_name}', 'w') as file:
-                    json.dump(response, file)
-
-        print('sending security indicators to Microsoft Graph Security\n')
-        print(f'{self.total_indicators} indicators are parsed from misp events. Only those that do not exist in Microsoft Graph Security will be sent.\n')
-        # print(f"current batch indicators sent:  {str(cur_batch_success_count + cur_batch_error_count).rjust(self.RJUST)}")
-        # print(f"current batch response success: {str(cur_batch_success_count).rjust(self.RJUST)}")
-        # print(f"current batch response error:   {str(cur_batch_error_count).rjust(self.RJUST)}\n")
-        #print(f"total indicators sent:          {str(self._get_total_indicators_sent()).rjust(self.RJUST)}")
-        #print(f"total response success:         {str(self.success_count).rjust(self.RJUST)}")
-        #print(f"total response error:           {str(self.error_count).rjust(self.RJUST)}\n")
-        cur_batch_took = self._get_timestamp() - self.last_batch_done_timestamp
-        self.last_batch_done_timestamp = self._get_timestamp()
-        print(f'current batch took:   {round(cur_batch_took, 2):{6}} seconds')
-        # avg_speed = self._get_total_indicators_sent() / (self.last_batch_done_timestamp - self.start_time)
-        # print(f'average speed so far: {round(avg_speed, 2):{6}} indicators per second')
-        # time_left = (self.total_indicators - self._get_total_indicators_sent()) / avg_speed
-        # print(f'estimated time left:  {round(time_left, 2):{6}} seconds')
+                self.log_writer.write('response', response)
+        # whatever the response left out is resubmitted next run
+        for fingerprint in fingerprints:
+            self.submissions_in_flight.pop(fingerprint, None)
+        self.state.commit()
 
-    @staticmethod
-    def _get_datetime_now():
-        return str(datetime.now()).replace(' ', '_')
+        self.reporter.progress(self._get_stats())
+
+    def _log_update(self, response, indicator_ids):
+        if 'error' in response:
+            # the claimed indicators are updated again next run
+            self.error_count += 1
+            self.log_writer.write('error', response['error'])
+            for indicator_id in indicator_ids:
+                if indicator_id in self.updates_in_flight:
+                    self._mark_failed(self.updates_in_flight[indicator_id][1])
+        else:
+            for value in response['value']:
+                update = self.updates_in_flight.pop(value.get('id'), None)
+                if update is None:
+                    continue
+                old_fingerprint, event_id, indicator = update
+                if "Error" in value:
+                    self.error_count += 1
+                    self.log_writer.write('error', value)
+                    # submitted anew instead, the old one is deleted next run
+                    self._queue_submission(indicator, event_id, get_identity(indicator, event_id))
+                else:
+                    self.update_count += 1
+                    self.state.replace(
+                        old_fingerprint, indicator[INDICATOR_REQUEST_HASH], event_id, self._serialize(indicator))
+                    if config.verbose_log:
+                        self.log_writer.write('update', value)
+        for indicator_id in indicator_ids:
+            self.updates_in_flight.pop(indicator_id, None)
+        self.state.commit()
+
+        self.reporter.progress(self._get_stats())
+
+    def _mark_failed(self, event_id):
+        # the event of a failed indicator is fetched again next run, the others are not held back by it
+        timestamp = self.event_timestamps.get(event_id, 0)
+        if self.earliest_failed_timestamp is None:
+            self.earliest_failed_timestamp = timestamp
+        else:
+            self.earliest_failed_timestamp = min(self.earliest_failed_timestamp, timestamp)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         #if config.targetProduct in TARGET_PRODUCT_BULK_SUPPORT:
         self._post_to_graph()
         # else:
         #     self._post_one_to_graph()
-
-        self._del_indicators_no_longer_exist()
-
-        self.expiration_date_fd.seek(0)
-        self.expiration_date_fd.write(self.expiration_date)
-        self.expiration_date_fd.truncate()
-
-        self.existing_indicators_hash_fd.seek(0)
-        json.dump(self.existing_indicators_hash, self.existing_indicators_hash_fd, indent=2)
-        self.existing_indicators_hash_fd.truncate()
-
-        self._print_summary()
+        self._post_updates_to_graph()
+        self._wait_for_posts_in_flight(0)
+        # updates that failed came back as submissions
+        self._post_to_graph()
+        self._wait_for_posts_in_flight(0)
+
+        # an interrupted run must not delete what it did not get to see yet
+        if exc_type is None and not self.partial:
+            with run_report.time('delete_stale'):
+                self._del_indicators_no_longer_exist()
+            # the mark stays at the earliest event with a failed indicator, the timestamp filter includes it
+            high_water_mark = self.high_water_mark
+            if self.earliest_failed_timestamp is not None:
+                high_water_mark = min(high_water_mark, self.earliest_failed_timestamp)
+            if high_water_mark:
+                self.state.set_meta('misp_high_water_mark', high_water_mark)
+            if not config.misp_incremental:
+                self.state.set_meta('indicators_parsed', self.total_indicators)
+            self.state.finish_run()
+            with run_report.time('delete_expired'):
+                self._delete_expired_indicators()
+        self.session.close()
+        self.state.__exit__(exc_type, exc_val, exc_tb)
+        self.log_writer.__exit__(exc_type, exc_val, exc_tb)
+
+        self.reporter.summary(self._get_stats())
+        run_report.add_target_stats(self._get_stats())
 
     def _del_indicators_no_longer_exist(self):
-        indicators = list(self.hash_of_indicators_to_delete.values())
-        self.del_count = len(indicators)
-        for i in range(0, len(indicators), 100):
-            request_body = {'value': indicators[i: i+100]}
-            response = requests.post(GRAPH_BULK_DEL_URL, headers=self.headers, json=request_body).json()
-            file_name = f"del_{self._get_datetime_now()}.json"
-            log_file_name = file_name.replace(':', '')
-            json.dump(response, open(f'{LOG_DIRECTORY_NAME}/{log_file_name}', 'w'), indent=2)
-        for hash_of_indicator_to_delete in self.hash_of_indicators_to_delete.keys():
-            self.existing_indicators_hash.pop(hash_of_indicator_to_delete, None)
-
-    def _print_summary(self):
-        self._clear_screen()
-        print('script finished running\n')
-        print(f"total indicators sent:    {str(self._get_total_indicators_sent()).rjust(self.RJUST)}")
-        print(f"total response success:   {str(self.success_count).rjust(self.RJUST)}")
-        print(f"total response error:     {str(self.error_count).rjust(self.RJUST)}")
-        print(f"total indicators deleted: {str(self.del_count).rjust(self.RJUST)}")
+        while True:
+            # a reconciled state knows no events, and the run fetched all of them anyway
+            rows = self.state.get_unseen(100, touched_only=config.misp_incremental and not self.reconcile)
+            if not rows:
+                break
+            request_body = {'value': [indicator_id for _, indicator_id in rows]}
+            response = self._get_json(self.graph_session.post(GRAPH_BULK_DEL_URL, headers=self.headers, json=request_body))
+            self.log_writer.write('delete', response)
+            self.state.remove(fingerprint for fingerprint, _ in rows)
+            self.state.commit()
+            self.del_count += len(rows)
+
+    def _get_graph_session_counts(self):
+        return {
+            'retries': self.graph_session.retry_count,
+            'throttles': self.graph_session.throttle_count,
+            'backoff_seconds': self.graph_session.wait_seconds,
+        }
+
+    def _get_stats(self):
+        return {
+            'target': self.target.name,
+            'parsed': self.total_indicators,
+            'sent': self._get_total_indicators_sent(),
+            'success': self.success_count,
+            'error': self.error_count,
+            'updated': self.update_count,
+            'deleted': self.del_count,
+            'expired': self.expired_count,
+            **{
+                name: round(count - self.graph_session_counts[name], 2)
+                for name, count in self._get_graph_session_counts().items()
+            },
+            'expected': self.expected_indicators,
+        }
 
     # def _post_one_to_graph(self):
     #     for indicator in self.indicators_to_be_sent:
@@ -193,78 +263,222 @@ class RequestManager:
     #     self._log_post(response)
 
     def _post_to_graph(self):
-        request_body = {'value': self.indicators_to_be_sent}
-        response = requests.post(GRAPH_BULK_POST_URL, headers=self.headers, json=request_body).json()
-        self.indicators_to_be_sent = []
-        self._log_post(response)
-
-    def delete_old_indicators():
-        access_token = RequestManager._get_access_token(
-            config.graph_auth[TENANT],
-            config.graph_auth[CLIENT_ID],
-            config.graph_auth[CLIENT_SECRET])
-
-        today = datetime.now()
- 
-        url = GRAPH_TI_INDICATORS_URL + '?$filter=expirationDateTime lt ' + today.strftime('%Y-%m-%d')
-
-        response = requests.get(
-            url,
-            headers={"Authorization": f"Bearer {access_token}"},
-            timeout=10,
-        ).json()
-
-        if 'error' in response:
-            print('ERROR during TI cleanup: ' + str(response['error']))
-            return
-
-        indicators = response['value']
-
-        if len(indicators) == 0:
-            print('No expired TI indicators found')
+        with run_report.time('graph_post'):
+            self._post_submissions()
+
+    def _post_submissions(self):
+        if self.submission_batch:
+            self._post_batch(GRAPH_BULK_POST_URL, *self.submission_batch.take(), self._log_post)
+        # block parsing until a slot frees up so it never runs ahead of the network
+        self._wait_for_posts_in_flight(config.graph_max_in_flight - 1)
+
+    def _post_updates_to_graph(self):
+        with run_report.time('graph_update'):
+            self._post_updates()
+
+    def _post_updates(self):
+        if self.update_batch:
+            self._post_batch(GRAPH_BULK_UPDATE_URL, *self.update_batch.take(), self._log_update)
+        self._wait_for_posts_in_flight(config.graph_max_in_flight - 1)
+
+    def _post_batch(self, url, request_body, offsets, keys, log_response):
+        headers = {**self.headers, 'Content-Type': 'application/json'}
+        # a submit that is resent after Graph processed it would leave duplicates behind
+        future = self.session.post(url, headers=headers, data=request_body, idempotent=url != GRAPH_BULK_POST_URL)
+        self.posts_in_flight.append((future, log_response, url, request_body, offsets, keys))
+
+    def _wait_for_posts_in_flight(self, max_in_flight):
+        # responses are handled in submission order
+        while len(self.posts_in_flight) > max_in_flight:
+            future, log_response, url, request_body, offsets, keys = self.posts_in_flight.popleft()
+            try:
+                response = future.result()
+            except requests.RequestException as e:
+                # not retried, the batch may or may not have been processed
+                with run_report.time('handle_response'):
+                    log_response({'error': {'code': type(e).__name__, 'message': str(e)}}, keys)
+                continue
+            self.reporter.batch_done(response.elapsed.total_seconds())
+            if response.status_code == 413:
+                if len(offsets) > 1:
+                    # nothing of a refused batch was taken, both halves are sent again
+                    run_report.count('split_batches')
+                    for half in RequestBatch.split(request_body, offsets, keys):
+                        self._post_batch(url, *half, log_response)
+                    continue
+                # the body of a 413 need not be json
+                response_json = {'error': {'code': 'RequestEntityTooLarge', 'message': f'{len(request_body)} bytes'}}
+            else:
+                response_json = self._get_json(response)
+            with run_report.time('handle_response'):
+                log_response(response_json, keys)
+
+    def _get_tiindicators(self, params):
+        """Yields the tiIndicators of our application, following Graph's paging lazily."""
+        url = GRAPH_TI_INDICATORS_URL
+        while url:
+            response = self._get_json(self.graph_session.get(url, headers=self.headers, params=params))
+            if 'error' in response:
+                print('ERROR while reading TI indicators: ' + str(response['error']))
+                self.log_writer.write('error', response['error'])
+                return
+            yield from response['value']
+            # the next link already carries the query
+            url = response.get('@odata.nextLink')
+            params = None
+
+    def _get_expired_indicator_ids(self):
+        params = {
+            '$filter': f"expirationDateTime lt {datetime.now().strftime('%Y-%m-%d')}",
+            '$select': 'id',
+        }
+        for indicator in self._get_tiindicators(params):
+            yield indicator['id']
+
+    def _delete_indicators(self, indicator_ids):
+        """Deletes indicators in batches of 100 with several batches in flight, returns how many."""
+        deleted_count = 0
+        deletes_in_flight = deque()
+        indicator_ids = iter(indicator_ids)
+        while True:
+            batch = list(islice(indicator_ids, 100))
+            if batch:
+                deletes_in_flight.append(
+                    self.session.post(GRAPH_BULK_DEL_URL, headers=self.headers, json={'value': batch}))
+                deleted_count += len(batch)
+            while deletes_in_flight and (not batch or len(deletes_in_flight) >= config.graph_max_in_flight):
+                self.log_writer.write('delete', self._get_json(deletes_in_flight.popleft().result()))
+                self.reporter.progress(self._get_stats())
+            if not batch:
+                return deleted_count
+
+    def _delete_expired_indicators(self):
+        # all pages are read before deleting, deletes would shift the pages still to come
+        self.expired_count += self._delete_indicators(list(self._get_expired_indicator_ids()))
+
+    def _get_tenant_fingerprints(self, stats):
+        """Yields (fingerprint, indicator id) of the live indicators this tool submitted to the tenant."""
+        params = {'$select': f'id,{INDICATOR_REQUEST_HASH},{EXPIRATION_DATE_TIME},targetProduct'}
+        today = datetime.utcnow().strftime('%Y-%m-%d')
+        for indicator in self._get_tiindicators(params):
+            stats['tenant'] += 1
+            if indicator.get('targetProduct', self.target.target_product) != self.target.target_product:
+                stats['other_product'] += 1
+            elif not indicator.get(INDICATOR_REQUEST_HASH):
+                stats['unfingerprinted'] += 1
+            elif str(indicator.get(EXPIRATION_DATE_TIME) or today)[:10] < today:
+                # cleaned up at the end of the run and resubmitted if misp still has it
+                stats['expired'] += 1
+            else:
+                yield indicator[INDICATOR_REQUEST_HASH], indicator['id']
+
+    def _reconcile_state(self):
+        """Rebuilds the fingerprint -> id index from what the tenant actually holds.
+
+        Indicators are matched on the indicatorRequestHash they were submitted
+        with, so the run that follows only submits what the tenant lacks and
+        deletes what misp no longer has, instead of resubmitting everything
+        after the state was lost or went stale. Extra copies of a fingerprint
+        are deleted right away, indicators without one are left alone.
+        """
+        print('reconciling state with the tenant...')
+        stats = defaultdict(int)
+        duplicate_ids = self.state.replace_indicators(self._get_tenant_fingerprints(stats))
+        # the rebuilt index knows no events, so this run fetches all of misp
+        self.high_water_mark = 0
+        self.state.commit()
+        stats['duplicates'] = self._delete_indicators(duplicate_ids)
+        stats['indexed'] = stats['tenant'] - stats['other_product'] - stats['unfingerprinted'] \
+            - stats['expired'] - stats['duplicates']
+        self.log_writer.write('reconcile', dict(stats))
+        print(f"reconciled: {stats['indexed']} of {stats['tenant']} tenant indicators indexed, "
+              f"{stats['duplicates']} duplicates deleted, {stats['unfingerprinted']} without fingerprint "
+              f"and {stats['other_product']} of other products left alone, {stats['expired']} expired")
+
+    def handle_event(self, event_id, timestamp):
+        # in incremental mode only indicators of events seen this run can be stale
+        if config.misp_incremental:
+            self.state.touch_event(event_id)
+        self.event_timestamps[event_id] = timestamp
+        self.high_water_mark = max(self.high_water_mark, timestamp)
+
+    def handle_indicator(self, indicator, event_id=None):
+        if not self.target.accepts(indicator):
             return
-
-        print('Looking at %d expired TI indicators' % len(indicators))
-
-        expiredIndicators = []
-        for tilIndicator in indicators:
-            tiID = tilIndicator['id']
-            expiredIndicators.append(tiID)
-
-        request_body = {'value': expiredIndicators}
-        response = requests.post(GRAPH_BULK_DEL_URL, headers={"Authorization": f"Bearer {access_token}"}, timeout=30, json=request_body).json()
-        print(response)
-
-    def handle_indicator(self, indicator):
-        self._update_headers_if_expired()
+        indicator = self.target.get_request_body(indicator)
+        self.total_indicators += 1
         indicator[EXPIRATION_DATE_TIME] = self.expiration_date
-        indicator_hash = self._get_request_hash(indicator)
-        indicator[INDICATOR_REQUEST_HASH] = indicator_hash
-        self.hash_of_indicators_to_delete.pop(indicator_hash, None) 
-        if indicator_hash not in self.existing_indicators_hash:
-            self.indicators_to_be_sent.append(indicator)
-        if len(self.indicators_to_be_sent) >= 100:
-            print(f"number of indicators sent: {self.success_count+self.error_count}")
-            self._post_to_graph()
-
-    def _update_headers_if_expired(self):
-        if self._get_timestamp() > self.headers_expiration_time:
-            access_token = self._get_access_token(
-                config.graph_auth[TENANT],
-                config.graph_auth[CLIENT_ID],
-                config.graph_auth[CLIENT_SECRET])
-            self.headers = {"Authorization": f"Bearer {access_token}"}
+        indicator_hash = indicator.get(INDICATOR_REQUEST_HASH)
+        if indicator_hash is None:
+            indicator_hash = self._get_request_hash(indicator)
+            indicator[INDICATOR_REQUEST_HASH] = indicator_hash
+        identity = get_identity(indicator, event_id)
+        # also gives indicators stored before their identity was known one
+        if not self.state.mark_seen(indicator_hash, event_id, identity):
+            changed = self.state.get_changed(identity)
+            update = changed and self._get_update(json.loads(changed[2]), indicator)
+            if update:
+                old_fingerprint, indicator_id, _ = changed
+                # claims the old indicator, so it is neither updated twice nor deleted this run
+                self.state.mark_seen(old_fingerprint, event_id)
+                item = self._serialize({'id': indicator_id, **update}).encode('utf-8')
+                if not self.update_batch.fits(item):
+                    self._post_batch(GRAPH_BULK_UPDATE_URL, *self.update_batch.take(), self._log_update)
+                self.update_batch.add(item, indicator_id)
+                self.updates_in_flight[indicator_id] = (old_fingerprint, event_id, indicator)
+            else:
+                self._queue_submission(indicator, event_id, identity)
+        # block parsing until a slot frees up so it never runs ahead of the network
+        if len(self.posts_in_flight) >= config.graph_max_in_flight:
+            with run_report.time('graph_wait'):
+                self._wait_for_posts_in_flight(config.graph_max_in_flight - 1)
+
+    def _queue_submission(self, indicator, event_id, identity):
+        # the same json goes to Graph and, once submitted, into the state
+        serialized = self._serialize(indicator)
+        item = serialized.encode('utf-8')
+        # posted without waiting, this also runs while a response is handled
+        if not self.submission_batch.fits(item):
+            self._post_batch(GRAPH_BULK_POST_URL, *self.submission_batch.take(), self._log_post)
+        self.submission_batch.add(item, indicator[INDICATOR_REQUEST_HASH])
+        self.submissions_in_flight[indicator[INDICATOR_REQUEST_HASH]] = (event_id, identity, serialized)
 
     @staticmethod
-    def _clear_screen():
-        if os.name == 'posix':
-            os.system('clear')
-        else:
-            os.system('cls')
+    def _get_update(old_indicator, indicator):
+        """Returns the fields that changed between two versions of an indicator.
+
+        None if updateTiIndicators cannot make the change, because a field
+        went away or one changed that cannot be updated in place. The
+        fingerprint is left out, Graph cannot update it.
+        """
+        if not old_indicator.keys() <= indicator.keys():
+            return None
+        update = {
+            field: value for field, value in indicator.items()
+            if field not in (INDICATOR_REQUEST_HASH, MISP_OBSERVABLE) and old_indicator.get(field) != value
+        }
+        if not update.keys() <= UPDATABLE_GRAPH_FIELDS:
+            return None
+        return update
+
+    @staticmethod
+    def _get_json(response):
+        """Returns the json of a response, or an error for one that has none, like a gateway error page."""
+        if response.headers.get('Content-Type', '').startswith('application/json'):
+            try:
+                return response.json()
+            except ValueError:
+                pass
+        return {'error': {'code': str(response.status_code), 'message': response.text[:200]}}
 
     @staticmethod
-    def _get_timestamp():
-        return datetime.now().timestamp()
+    def _serialize(indicator):
+        if indicator is None:
+            return None
+        # Graph does not know the misp observable
+        if MISP_OBSERVABLE in indicator:
+            indicator = {field: value for field, value in indicator.items() if field != MISP_OBSERVABLE}
+        return json.dumps(indicator, separators=(',', ':'), ensure_ascii=False, default=str)
 
     def _get_total_indicators_sent(self):
-        return self.error_count + self.success_count
\ No newline at end of file
+        return self.error_count + self.success_count + self.update_count
\ No newline at end of file
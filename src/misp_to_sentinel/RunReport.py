@@ -0,0 +1,160 @@
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+
+
+class RunReport:
+    """A class that times the stages of a run and writes what it found as json
+
+    Every stage accumulates wall time, CPU time of the thread it ran in and
+    a call count. Stages nest, handle_indicator for example includes the
+    Graph posts it blocks on. Worker processes (PARSE_WORKERS > 1) keep a
+    report of their own and hand its stages back to be added up here.
+
+    to use the class:
+        run_report.reset()
+        with run_report.time('parse'):
+            parse_event(event)
+        for event in run_report.timed('misp_fetch', events):
+            ...
+        run_report.write(RUN_REPORT_FILE_NAME)
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = datetime.now()
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        # stage -> [wall seconds, cpu seconds, calls]
+        self.stages = defaultdict(lambda: [0.0, 0.0, 0])
+        self.counters = Counter()
+        self.targets = []
+
+    def reset(self):
+        """Starts over, for a process that runs more than once."""
+        self.__init__()
+
+    def add_time(self, stage, wall_seconds, cpu_seconds):
+        with self.lock:
+            totals = self.stages[stage]
+            totals[0] += wall_seconds
+            totals[1] += cpu_seconds
+            totals[2] += 1
+
+    @contextmanager
+    def time(self, stage):
+        start_wall = time.perf_counter()
+        start_cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start_wall, time.thread_time() - start_cpu)
+
+    def timed(self, stage, iterable):
+        """Yields from iterable, timing each step of it as stage."""
+        iterator = iter(iterable)
+        while True:
+            start_wall = time.perf_counter()
+            start_cpu = time.thread_time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.add_time(stage, time.perf_counter() - start_wall, time.thread_time() - start_cpu)
+            yield item
+
+    def get_stages(self):
+        with self.lock:
+            return {stage: tuple(totals) for stage, totals in self.stages.items()}
+
+    def add_stages(self, stages):
+        """Adds the stages of another report, e.g. the one of a worker process."""
+        with self.lock:
+            for stage, (wall_seconds, cpu_seconds, calls) in stages.items():
+                totals = self.stages[stage]
+                totals[0] += wall_seconds
+                totals[1] += cpu_seconds
+                totals[2] += calls
+
+    def count(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] += amount
+
+    def add_target_stats(self, stats):
+        with self.lock:
+            self.targets.append(dict(stats))
+
+    def to_dict(self):
+        with self.lock:
+            stages = {
+                stage: {'wall_seconds': round(wall, 4), 'cpu_seconds': round(cpu, 4), 'calls': calls}
+                for stage, (wall, cpu, calls) in sorted(self.stages.items())
+            }
+            return {
+                'start_time': str(self.start_time),
+                'end_time': str(datetime.now()),
+                'wall_seconds': round(time.perf_counter() - self.start_wall, 4),
+                'cpu_seconds': round(time.process_time() - self.start_cpu, 4),
+                # kilobytes on linux
+                'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+                'stages': stages,
+                'counters': dict(self.counters),
+                'targets': list(self.targets),
+            }
+
+    def write(self, file_name):
+        # replace the file in one go so a reader never sees half of it
+        with open(f'{file_name}.tmp', 'w') as file:
+            json.dump(self.to_dict(), file, indent=2)
+        os.replace(f'{file_name}.tmp', file_name)
+
+
+class SamplingProfiler:
+    """Samples the stacks of all threads at an interval and writes them as folded stacks
+
+    Unlike cProfile it covers every thread, at a cost that does not grow with
+    the number of calls. The output feeds flamegraph.pl or speedscope.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = Counter()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self.thread.start()
+
+    def stop(self, file_name):
+        self.stopping.set()
+        self.thread.join()
+        with open(file_name, 'w') as file:
+            for stack, count in self.samples.most_common():
+                file.write(f'{stack} {count}\n')
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self.stopping.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.samples[';'.join(reversed(stack))] += 1
+
+
+run_report = RunReport()
@@ -0,0 +1,191 @@
+import json
+import os
+import sqlite3
+
+from fingerprint import split_legacy_fingerprints
+
+
+class StateStore:
+    """A class that persists which indicators exist in Graph across runs
+
+    Every indicator is stored as fingerprint -> Graph id together with its
+    misp event and the last run that saw it in misp. Indicators submitted
+    since also keep their identity and the body they were submitted with, so
+    a changed indicator can be found and updated in place. Changes are committed
+    per batch to a SQLite database in WAL mode, so an interrupted run keeps
+    what it submitted and the next run resumes it instead of starting over.
+
+    to use the class:
+        with StateStore(STATE_DB_FILE_NAME) as state:
+            state.start_run()
+            if not state.mark_seen(fingerprint):
+                state.add(fingerprint, indicator_id)
+            state.commit()
+
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.run_id = None
+
+    def __enter__(self):
+        self.connection = sqlite3.connect(self.file_name)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS indicators ('
+            'fingerprint TEXT PRIMARY KEY, indicator_id TEXT NOT NULL, seen_run INTEGER NOT NULL, event_id TEXT)')
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(indicators)')]
+        for column, column_type in (('event_id', 'TEXT'), ('identity', 'BLOB'), ('body', 'TEXT')):
+            if column not in columns:
+                self.connection.execute(f'ALTER TABLE indicators ADD COLUMN {column} {column_type}')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS indicators_seen_run ON indicators (seen_run)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS indicators_event_id ON indicators (event_id)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS indicators_identity ON indicators (identity)')
+        self.connection.execute('CREATE TEMP TABLE touched_events (event_id TEXT PRIMARY KEY)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self.connection.commit()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.connection.commit()
+        self.connection.close()
+
+    def get_meta(self, key, default=None):
+        row = self.connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def set_meta(self, key, value):
+        self.connection.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, str(value)))
+
+    def migrate_json(self, hash_file_name, expiration_date_file_name):
+        """Imports the json state files of older versions once, then renames them."""
+        if not os.path.exists(hash_file_name):
+            return
+        try:
+            with open(hash_file_name) as file:
+                existing_indicators_hash = json.load(file)
+        except json.decoder.JSONDecodeError:
+            existing_indicators_hash = {}
+        _, legacy_indicators_hash = split_legacy_fingerprints(existing_indicators_hash)
+        if legacy_indicators_hash:
+            print(f'migrating {len(legacy_indicators_hash)} indicators with legacy fingerprints, they will be resubmitted once')
+        # run 0 is never current, so anything not seen again is deleted at the end of the run
+        self.connection.executemany(
+            'INSERT OR IGNORE INTO indicators (fingerprint, indicator_id, seen_run) VALUES (?, ?, 0)',
+            existing_indicators_hash.items())
+        if os.path.exists(expiration_date_file_name):
+            with open(expiration_date_file_name) as file:
+                self.set_meta('expiration_date', file.read().strip())
+            os.replace(expiration_date_file_name, f'{expiration_date_file_name}.migrated')
+        self.connection.commit()
+        os.replace(hash_file_name, f'{hash_file_name}.migrated')
+
+    def start_run(self):
+        """Starts a new run, or resumes the last one if it never finished."""
+        run_id = int(self.get_meta('run_id', 0))
+        if self.get_meta('run_finished', '1') == '1':
+            run_id += 1
+        else:
+            print(f'resuming interrupted run {run_id}')
+        self.run_id = run_id
+        self.set_meta('run_id', run_id)
+        self.set_meta('run_finished', '0')
+        self.connection.commit()
+        return run_id
+
+    def join_run(self):
+        """Joins the last run without starting a new one, for submitting outside of a full run."""
+        self.run_id = int(self.get_meta('run_id', 0))
+        return self.run_id
+
+    def finish_run(self):
+        self.set_meta('run_finished', '1')
+        self.connection.commit()
+
+    def clear(self):
+        """Forgets all indicators, and so the misp high-water mark built on them."""
+        self.connection.execute('DELETE FROM indicators')
+        self.connection.execute("DELETE FROM meta WHERE key = 'misp_high_water_mark'")
+
+    def replace_indicators(self, indicators):
+        """Replaces all indicators with (fingerprint, indicator id) pairs read back from Graph.
+
+        They get run 0 like migrated ones, so whatever misp no longer has is
+        deleted at the end of the run. As with clear, the misp high-water mark
+        goes too. Returns the ids of indicators whose fingerprint was already
+        taken, duplicates that can be deleted.
+        """
+        self.clear()
+        duplicate_ids = []
+        for fingerprint, indicator_id in indicators:
+            inserted = self.connection.execute(
+                'INSERT OR IGNORE INTO indicators (fingerprint, indicator_id, seen_run) VALUES (?, ?, 0)',
+                (fingerprint, indicator_id)).rowcount
+            if not inserted:
+                duplicate_ids.append(indicator_id)
+        return duplicate_ids
+
+    def touch_event(self, event_id):
+        """Records that an event was fetched this run, so its unseen indicators are stale."""
+        self.connection.execute('INSERT OR IGNORE INTO touched_events (event_id) VALUES (?)', (event_id,))
+
+    def mark_seen(self, fingerprint, event_id=None, identity=None):
+        """Marks an indicator as still in misp, returns whether it exists in Graph."""
+        return self.connection.execute(
+            'UPDATE indicators SET seen_run = ?, event_id = coalesce(?, event_id), identity = coalesce(?, identity) '
+            'WHERE fingerprint = ?',
+            (self.run_id, event_id, identity, fingerprint)
+        ).rowcount > 0
+
+    def add(self, fingerprint, indicator_id, event_id=None, identity=None, body=None):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO indicators (fingerprint, indicator_id, seen_run, event_id, identity, body) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (fingerprint, indicator_id, self.run_id, event_id, identity, body))
+
+    def get_changed(self, identity):
+        """Returns (fingerprint, indicator id, body) of the indicator with an identity, if not seen this run.
+
+        An indicator not seen yet whose identity comes up again under another
+        fingerprint is the same indicator, changed.
+        """
+        return self.connection.execute(
+            'SELECT fingerprint, indicator_id, body FROM indicators '
+            'WHERE identity = ? AND seen_run < ? AND body IS NOT NULL LIMIT 1', (identity, self.run_id)
+        ).fetchone()
+
+    def replace(self, old_fingerprint, fingerprint, event_id, body):
+        """Moves an indicator updated in place to its new fingerprint and body.
+
+        Another indicator may have been updated into the same fingerprint this
+        run already. This one is then a duplicate of it, it is left under its
+        old fingerprint and unseen, so it is deleted at the end of the run.
+        """
+        try:
+            self.connection.execute(
+                'UPDATE indicators SET fingerprint = ?, seen_run = ?, event_id = ?, body = ? WHERE fingerprint = ?',
+                (fingerprint, self.run_id, event_id, body, old_fingerprint))
+        except sqlite3.IntegrityError:
+            self.connection.execute(
+                'UPDATE indicators SET seen_run = ? WHERE fingerprint = ?', (self.run_id - 1, old_fingerprint))
+
+    def get_unseen(self, limit, touched_only=False):
+        """Returns up to limit (fingerprint, indicator id) pairs not seen in this run.
+
+        With touched_only, only indicators of events fetched this run are returned.
+        """
+        if touched_only:
+            return self.connection.execute(
+                'SELECT fingerprint, indicator_id FROM indicators WHERE seen_run < ? '
+                'AND event_id IN (SELECT event_id FROM touched_events) LIMIT ?', (self.run_id, limit)
+            ).fetchall()
+        return self.connection.execute(
+            'SELECT fingerprint, indicator_id FROM indicators WHERE seen_run < ? LIMIT ?', (self.run_id, limit)
+        ).fetchall()
+
+    def remove(self, fingerprints):
+        self.connection.executemany('DELETE FROM indicators WHERE fingerprint = ?', ((f,) for f in fingerprints))
+
+    def commit(self):
+        self.connection.commit()
@@ -0,0 +1,103 @@
+import json
+import os
+import re
+
+import config
+from constants import *
+from fingerprint import get_fingerprint
+
+_TARGET_NAME_RE = re.compile(r'^[\w.-]+$')
+
+
+class Target:
+    """A tenant the indicators are submitted to, with its own credentials, state and overrides
+
+    targetProduct, action, passiveOnly and the expiry default to the global
+    config. A target can also narrow down which indicators it gets by tags
+    and TLP level. The target built from the AZ_* settings has no name and
+    keeps the state and log locations of a single tenant setup.
+
+    to use the class:
+        for target in get_targets():
+            if target.accepts(request_body):
+                request_body = target.get_request_body(request_body)
+
+    """
+
+    def __init__(self, name, tenant, client_id, client_secret, target_product=None, action=None,
+                 passive_only=None, days_to_expire=None, include_tags=(), exclude_tags=(), tlp_levels=()):
+        if name is not None and not _TARGET_NAME_RE.match(name):
+            raise ValueError(f'target name {name!r} may only hold letters, digits, dots, dashes and underscores')
+        self.name = name
+        self.tenant = tenant
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.target_product = target_product or config.targetProduct
+        self.action = action or config.action
+        self.passive_only = config.passiveOnly if passive_only is None else passive_only
+        self.days_to_expire = int(days_to_expire or config.days_to_expire)
+        self.include_tags = frozenset(include_tags)
+        self.exclude_tags = frozenset(exclude_tags)
+        self.tlp_levels = frozenset(tlp_levels)
+        # fields translation fills from the global config, only differing ones are overridden
+        self.overrides = {
+            field: value for field, value, default in (
+                ('targetProduct', self.target_product, config.targetProduct),
+                ('action', self.action, config.action),
+                ('passiveOnly', self.passive_only, config.passiveOnly),
+            ) if value != default
+        }
+
+    @classmethod
+    def from_config(cls):
+        return cls(None, config.graph_auth[TENANT], config.graph_auth[CLIENT_ID], config.graph_auth[CLIENT_SECRET])
+
+    def __str__(self):
+        return self.name or self.tenant or 'default'
+
+    @property
+    def state_file_name(self):
+        return STATE_DB_FILE_NAME if self.name is None else f'{DATA_DIRECTORY}/state-{self.name}.db'
+
+    @property
+    def log_directory_name(self):
+        return LOG_DIRECTORY_NAME if self.name is None else f'{LOG_DIRECTORY_NAME}/{self.name}'
+
+    def accepts(self, request_body):
+        if self.tlp_levels and request_body.get('tlpLevel') not in self.tlp_levels:
+            return False
+        tags = request_body['tags']
+        if self.include_tags and self.include_tags.isdisjoint(tags):
+            return False
+        return self.exclude_tags.isdisjoint(tags)
+
+    def get_request_body(self, request_body):
+        """Returns the request body as this target submits it.
+
+        Bodies are shared by all targets, so this is always a copy. With
+        overrides the fingerprint is taken again, so changing an override
+        resubmits the indicators.
+        """
+        if not self.overrides:
+            return dict(request_body)
+        request_body = {**request_body, **self.overrides}
+        request_body[INDICATOR_REQUEST_HASH] = get_fingerprint(request_body)
+        return request_body
+
+
+def get_targets():
+    """Returns the targets in TARGETS_FILE, or the single one configured by the AZ_* settings."""
+    if not config.targets_file:
+        return [Target.from_config()]
+    with open(config.targets_file) as file:
+        entries = json.load(file)
+    targets = []
+    for entry in entries:
+        # keeps the secret itself out of the file
+        if 'client_secret_env' in entry:
+            entry['client_secret'] = os.environ.get(entry.pop('client_secret_env'))
+        targets.append(Target(**entry))
+    names = [target.name for target in targets]
+    if None in names or len(set(names)) != len(names):
+        raise ValueError(f'every target in {config.targets_file} needs a unique name')
+    return targets
@@ -0,0 +1,124 @@
+import json
+import os
+import threading
+import time
+
+import config
+from constants import *
+from GraphSession import login_session
+
+
+class TokenProvider:
+    """A class that hands out Graph access tokens, one provider per tenant and client
+
+    Tokens are cached until shortly before the expires_in Azure returns and
+    refreshed in a background timer ahead of that, so submitters never wait on
+    login.microsoftonline.com. All methods are thread-safe. With
+    TOKEN_CACHE_FILE set, tokens are also kept on disk for the next cron run.
+
+    to use the class:
+        token_provider = TokenProvider.get(tenant, client_id, client_secret)
+        response = graph_session.get(url, headers=token_provider.get_headers())
+
+    """
+
+    USER_AGENT = 'MISP/1.0'
+
+    _providers = {}
+    _providers_lock = threading.Lock()
+    _cache_file_lock = threading.Lock()
+
+    def __init__(self, tenant, client_id, client_secret):
+        self.tenant = tenant
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.lock = threading.Lock()
+        self.access_token = None
+        self.expires_at = 0.0
+        self.refresh_timer = None
+        self._load_cached_token()
+
+    @classmethod
+    def get(cls, tenant, client_id, client_secret):
+        with cls._providers_lock:
+            key = (tenant, client_id)
+            if key not in cls._providers:
+                cls._providers[key] = cls(tenant, client_id, client_secret)
+            return cls._providers[key]
+
+    @classmethod
+    def from_config(cls):
+        return cls.get(config.graph_auth[TENANT], config.graph_auth[CLIENT_ID], config.graph_auth[CLIENT_SECRET])
+
+    def get_access_token(self):
+        with self.lock:
+            if self.access_token is None or time.time() >= self.expires_at - config.token_refresh_margin:
+                self._refresh()
+            return self.access_token
+
+    def get_headers(self):
+        return {"Authorization": f"Bearer {self.get_access_token()}", 'user-agent': self.USER_AGENT}
+
+    def _refresh(self):
+        data = {
+            CLIENT_ID: self.client_id,
+            'scope': 'https://graph.microsoft.com/.default',
+            CLIENT_SECRET: self.client_secret,
+            'grant_type': 'client_credentials'
+        }
+        response = login_session.post(
+            f'{AZURE_LOGIN_URL}/{self.tenant}/oauth2/v2.0/token',
+            data=data
+        ).json()
+        self.access_token = response[ACCESS_TOKEN]
+        self.expires_at = time.time() + int(response.get('expires_in', 3600))
+        self._save_cached_token()
+        self._schedule_refresh()
+
+    def _schedule_refresh(self):
+        if self.refresh_timer is not None:
+            self.refresh_timer.cancel()
+        delay = max(0.0, self.expires_at - config.token_refresh_margin - time.time())
+        self.refresh_timer = threading.Timer(delay, self._refresh_in_background)
+        self.refresh_timer.daemon = True
+        self.refresh_timer.start()
+
+    def _refresh_in_background(self):
+        try:
+            with self.lock:
+                self._refresh()
+        except Exception as e:
+            # the next get_access_token retries in the foreground
+            print(f'background token refresh failed: {e}')
+
+    def _cache_key(self):
+        return f'{self.tenant}/{self.client_id}'
+
+    def _read_cache_file(self):
+        try:
+            with open(config.token_cache_file) as file:
+                return json.load(file)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            return {}
+
+    def _load_cached_token(self):
+        if not config.token_cache_file:
+            return
+        with self._cache_file_lock:
+            cached = self._read_cache_file().get(self._cache_key())
+        if cached and cached['expires_at'] - config.token_refresh_margin > time.time():
+            self.access_token = cached[ACCESS_TOKEN]
+            self.expires_at = cached['expires_at']
+            self._schedule_refresh()
+
+    def _save_cached_token(self):
+        if not config.token_cache_file:
+            return
+        with self._cache_file_lock:
+            cache = self._read_cache_file()
+            cache[self._cache_key()] = {ACCESS_TOKEN: self.access_token, 'expires_at': self.expires_at}
+            # the token grants tenant access, keep it readable by this user only
+            fd = os.open(f'{config.token_cache_file}.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as file:
+                json.dump(cache, file)
+            os.replace(f'{config.token_cache_file}.tmp', config.token_cache_file)
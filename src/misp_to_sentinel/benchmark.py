@@ -0,0 +1,636 @@
+"""Offline benchmarks for the MISP to Graph sync, no MISP or tenant needed.
+
+usage:
+    python benchmark.py fingerprint [-n INDICATORS]
+    python benchmark.py http [-n REQUESTS]
+    python benchmark.py translate [-n ATTRIBUTES]
+    python benchmark.py assemble [-n EVENTS] [-a ATTRIBUTES_PER_EVENT]
+    python benchmark.py parse [-n EVENTS] [-a ATTRIBUTES_PER_EVENT] [-w MAX_WORKERS] [-c CHUNK_SIZE]
+    python benchmark.py dump [-n EVENTS] [-a ATTRIBUTES_PER_EVENT] [-o DUMP_FILE]
+    python benchmark.py e2e [-n EVENTS] [-a ATTRIBUTES_PER_EVENT] [-m FETCH_MODE] [-r RUNS] [-t TARGETS] [--reconcile]
+                            [--change-rate RATE]
+                            [--latency SECONDS] [--throttle-rate RATE] [--error-rate RATE]
+                            [--max-request-bytes BYTES] [--batch-bytes BYTES]
+    python benchmark.py merge [-n EVENTS] [-a ATTRIBUTES_PER_EVENT] [-o OBSERVABLES]
+    python benchmark.py push [-n EVENTS] [-a ATTRIBUTES_PER_EVENT] [-p PUSHES] [-b BURST] [--webhook]
+"""
+import argparse
+import json
+import math
+import os
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.request import Request, urlopen
+
+# config refuses to import without it, benchmarks never look at it
+os.environ.setdefault('AZ_DAYS_TO_EXPIRE', '30')
+
+import config
+from constants import *
+from dump_reader import read_dump
+from fingerprint import get_fingerprint
+from merge import merge_parsed_events
+from mock_services import MockGraph, MockMisp, MockZmqPublisher, synthetic_attribute, synthetic_event
+from parallel_parse import parse_events_in_processes
+from translation import graph_post_request_bodies, parse_event_request_bodies, translate_attribute
+
+GRAPH_BATCH_SIZE = 100
+
+
+def _legacy_fingerprint(request):
+    return str(hash(frozenset({
+        k: str(v) for k, v in request.items()
+        if k != 'expirationDateTime' and k != 'lastReportedDateTime'
+    }.items())))
+
+
+def synthetic_indicator(i):
+    return {
+        'action': 'alert',
+        'passiveOnly': False,
+        'threatType': 'watchlist',
+        'targetProduct': 'Azure Sentinel',
+        'tlpLevel': 'amber',
+        'description': f'synthetic event {i // 20}',
+        'externalId': f'00000000-0000-0000-0000-{i:012d}',
+        'lastReportedDateTime': '2023-01-01 00:00:00',
+        'expirationDateTime': '2023-02-01',
+        'tags': ['tlp:amber', f'campaign:{i % 7}'],
+        'networkDestinationIPv4': f'10.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}',
+    }
+
+
+def _fingerprint_run(indicators):
+    """Fingerprints a synthetic corpus in a fresh interpreter, like one cron run."""
+    env = dict(os.environ, PYTHONHASHSEED='random')
+    output = subprocess.run(
+        [sys.executable, __file__, '_fingerprints', '-n', str(indicators)],
+        env=env, check=True, capture_output=True, text=True,
+    ).stdout
+    return json.loads(output)
+
+
+def bench_fingerprint(args):
+    first = _fingerprint_run(args.indicators)
+    second = _fingerprint_run(args.indicators)
+    print(f'indicators per run:         {args.indicators}')
+    for name in ('legacy', 'stable'):
+        matched = len(set(first[name]) & set(second[name]))
+        resubmitted = args.indicators - matched
+        # a resubmitted indicator costs a submit and later a delete of its old id
+        calls = 2 * math.ceil(resubmitted / GRAPH_BATCH_SIZE)
+        print(f'{name:7} fingerprints matched: {matched:>8}, '
+              f'graph calls on no-change rerun: {calls:>6}, '
+              f'fingerprint time: {first[name + "_seconds"]:.3f}s')
+
+
+def _print_fingerprints(args):
+    corpus = [synthetic_indicator(i) for i in range(args.indicators)]
+    start = time.perf_counter()
+    legacy = [_legacy_fingerprint(indicator) for indicator in corpus]
+    legacy_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    stable = [get_fingerprint(indicator) for indicator in corpus]
+    stable_seconds = time.perf_counter() - start
+    json.dump({
+        'legacy': legacy,
+        'legacy_seconds': legacy_seconds,
+        'stable': stable,
+        'stable_seconds': stable_seconds,
+    }, sys.stdout)
+
+
+class _LegacyRequestObject:
+    """The per-attribute dispatch translation.py replaced, kept as parity reference."""
+    def __init__(self, attr):
+        mapping = ATTR_MAPPING.get(attr['type'])
+        if mapping is not None:
+            setattr(self, mapping, attr['value'])
+        if attr['type'] in MISP_SPECIAL_CASE_TYPES:
+            self._handle_special_cases(attr)
+        self.tags = [tag['name'].strip() for tag in attr.get("Tag", [])]
+        for tag in self.tags:
+            if 'diamond-model:' in tag:
+                self.diamondModel = tag.split(':')[1]
+
+    def _handle_ip(self, attr, attr_type, graph_v4_name, graph_v6_name):
+        if attr['type'] == attr_type:
+            if '.' in attr['value']:
+                setattr(self, graph_v4_name, attr['value'])
+            else:
+                setattr(self, graph_v6_name, attr['value'])
+
+    def _aggregated_handle_ip(self, attr):
+        self._handle_ip(attr, 'ip-dst', 'networkDestinationIPv4', 'networkDestinationIPv6')
+        self._handle_ip(attr, 'ip-src', 'networkSourceIPv4', 'networkSourceIPv6')
+
+    def _handle_file_hash(self, attr):
+        if attr['type'] in MISP_HASH_TYPES:
+            if 'filename|' in attr['type']:
+                self.fileHashType = attr['type'].split('|')[1]
+                self.fileName, self.fileHashValue = attr['value'].split('|')
+            else:
+                self.fileHashType = attr['type']
+                self.fileHashValue = attr['value']
+            if self.fileHashType not in ['sha1', 'sha256', 'md5', 'authenticodeHash256', 'lsHash', 'ctph']:
+                self.fileHashType = "unknown"
+
+    def _handle_email_src(self, attr):
+        if attr['type'] == 'email-src':
+            self.emailSenderAddress = attr['value']
+            self.emailSourceDomain = attr['value'].split('@')[1]
+
+    def _handle_ip_port(self, attr):
+        if attr['type'] == 'ip-dst|port' or attr['type'] == 'ip-src|port':
+            ip = attr['value'].split('|')[0]
+            port = attr['value'].split('|')[1]
+            if attr['type'] == 'ip-dst|port':
+                self.networkDestinationPort = port
+                if '.' in attr['value']:
+                    self.networkDestinationIPv4 = ip
+                else:
+                    self.networkDestinationIPv6 = ip
+            elif attr['type'] == 'ip-src|port':
+                self.networkSourcePort = port
+                if '.' in attr['value']:
+                    self.networkSourceIPv4 = ip
+                else:
+                    self.networkSourceIPv6 = ip
+
+    def _handle_special_cases(self, attr):
+        self._aggregated_handle_ip(attr)
+        self._handle_domain_ip(attr)
+        self._handle_email_src(attr)
+        self._handle_ip_port(attr)
+        self._handle_file_hash(attr)
+
+    def _handle_domain_ip(self, attr):
+        if attr['type'] == 'domain|ip':
+            self.domainName, ip = attr['value'].split('|')
+            if '.' in ip:
+                self.networkIPv4 = ip
+            else:
+                self.networkIPv6 = ip
+
+
+def bench_translate(args):
+    types = sorted(MISP_ACTIONABLE_TYPES)
+    corpus = [synthetic_attribute(i, types) for i in range(args.attributes)]
+
+    start = time.perf_counter()
+    legacy = [_LegacyRequestObject(attr).__dict__ for attr in corpus]
+    legacy_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    translated = [translate_attribute(attr) for attr in corpus]
+    table_seconds = time.perf_counter() - start
+
+    # the misp observable is new, the legacy objects never carried it
+    mismatches = sum(
+        1 for old, new in zip(legacy, translated)
+        if old != {field: value for field, value in new.items() if field != MISP_OBSERVABLE})
+    print(f'attributes:               {args.attributes}')
+    print(f'per-attribute dispatch:   {legacy_seconds:.3f}s')
+    print(f'translation table:        {table_seconds:.3f}s')
+    print(f'parity mismatches:        {mismatches}')
+    if mismatches:
+        sys.exit(1)
+
+
+def _legacy_request_bodies(parsed_events):
+    """The request body assembly graph_post_request_bodies replaced, kept as parity reference."""
+    for event in parsed_events:
+        request_body_metadata = {
+            **{field: event[field] for field in REQUIRED_GRAPH_METADATA},
+            **{field: event[field] for field in OPTIONAL_GRAPH_METADATA if field in event},
+            'action': config.action,
+            'passiveOnly': config.passiveOnly,
+            'threatType': 'watchlist',
+            'targetProduct': config.targetProduct,
+        }
+        for request_object in event['request_objects']:
+            request_body = {
+                **request_body_metadata.copy(),
+                **request_object,
+                'tags': request_body_metadata.copy()['tags'] + request_object['tags']
+            }
+            request_body[EXPIRATION_DATE_TIME] = '2023-02-01'
+            request_body[INDICATOR_REQUEST_HASH] = get_fingerprint(request_body)
+            yield request_body
+
+
+def _request_bodies(parsed_events):
+    for event in parsed_events:
+        for request_body in graph_post_request_bodies(event):
+            request_body[EXPIRATION_DATE_TIME] = '2023-02-01'
+            yield request_body
+
+
+def synthetic_parsed_event(i, attributes_per_event, types):
+    parsed_event = defaultdict(list)
+    parsed_event.update({
+        'description': f'synthetic event {i}',
+        'externalId': f'{i:032x}',
+        'firstReportedDateTime': '2023-01-01',
+        'lastReportedDateTime': '2023-01-01 00:00:00',
+        'tags': ['tlp:amber', f'campaign:{i % 7}', 'misp-galaxy:threat-actor="APT"'],
+        'tlpLevel': 'amber',
+        'activityGroupNames': ['APT'],
+    })
+    parsed_event['request_objects'] = [
+        translate_attribute(synthetic_attribute(i * attributes_per_event + j, types))
+        for j in range(attributes_per_event)
+    ]
+    return parsed_event
+
+
+def _measure(assemble, parsed_events):
+    start = time.perf_counter()
+    for _ in assemble(parsed_events):
+        pass
+    seconds = time.perf_counter() - start
+    # the peak above what was live before each body covers the body and its temporary copies
+    tracemalloc.start()
+    allocated = 0
+    last_current = tracemalloc.get_traced_memory()[0]
+    for _ in assemble(parsed_events):
+        current, peak = tracemalloc.get_traced_memory()
+        allocated += peak - last_current
+        last_current = current
+        tracemalloc.reset_peak()
+    tracemalloc.stop()
+    return seconds, allocated
+
+
+def bench_assemble(args):
+    types = sorted(MISP_ACTIONABLE_TYPES)
+    parsed_events = [synthetic_parsed_event(i, args.attributes, types) for i in range(args.events)]
+    indicators = args.events * args.attributes
+
+    mismatches = sum(
+        1 for old, new in zip(_legacy_request_bodies(parsed_events), _request_bodies(parsed_events))
+        if old != new
+    )
+    legacy_seconds, legacy_allocated = _measure(_legacy_request_bodies, parsed_events)
+    seconds, allocated = _measure(_request_bodies, parsed_events)
+    print(f'indicators:               {indicators}')
+    print(f'copying assembly:         {legacy_seconds:.3f}s, {legacy_allocated / indicators:.0f} peak bytes per body')
+    print(f'single-pass assembly:     {seconds:.3f}s, {allocated / indicators:.0f} peak bytes per body')
+    print(f'parity mismatches:        {mismatches}')
+    if mismatches:
+        sys.exit(1)
+
+
+def bench_parse(args):
+    types = sorted(MISP_ACTIONABLE_TYPES)
+    events = [synthetic_event(i, args.attributes, types) for i in range(args.events)]
+    indicators = args.events * args.attributes
+    print(f'events:                   {args.events}')
+    print(f'indicators:               {indicators}')
+
+    start = time.perf_counter()
+    expected = [parse_event_request_bodies(event) for event in events]
+    baseline_seconds = time.perf_counter() - start
+    print(f'in process:               {baseline_seconds:.3f}s')
+
+    workers = 1
+    while workers <= args.workers:
+        start = time.perf_counter()
+        parsed = list(parse_events_in_processes(events, workers, args.chunk_size))
+        seconds = time.perf_counter() - start
+        status = 'ok' if parsed == expected else 'MISMATCH'
+        print(f'{workers:>3} worker processes:     {seconds:.3f}s, {baseline_seconds / seconds:.2f}x, {status}')
+        workers *= 2
+
+
+def write_synthetic_dump(file_name, events, attributes_per_event):
+    """Writes a restSearch style export one event at a time, for a reproducible input."""
+    types = sorted(MISP_ACTIONABLE_TYPES)
+    with open(file_name, 'w', encoding='utf-8') as file:
+        file.write('{"response": [')
+        for i in range(events):
+            if i:
+                file.write(',\n')
+            json.dump({'Event': synthetic_event(i, attributes_per_event, types)}, file)
+        file.write(']}\n')
+
+
+def bench_dump(args):
+    file_name = args.output or os.path.join(tempfile.mkdtemp(), 'misp_dump.json')
+    write_synthetic_dump(file_name, args.events, args.attributes)
+    file_size = os.path.getsize(file_name)
+
+    start = time.perf_counter()
+    indicators = 0
+    for event in read_dump([file_name]):
+        indicators += len(parse_event_request_bodies(event)[2])
+    seconds = time.perf_counter() - start
+    # kilobytes on linux, and the writer above only ever held a single event
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    if not args.output:
+        os.remove(file_name)
+
+    print(f'dump size:                {file_size / 2 ** 20:.1f} MiB')
+    print(f'events:                   {args.events}')
+    print(f'indicators:               {indicators}')
+    print(f'read and parse:           {seconds:.3f}s, {args.events / seconds:.0f} events/s')
+    print(f'peak rss:                 {peak_rss / 2 ** 20:.1f} MiB')
+
+
+class _EchoHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        body = b'{"value":[]}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def bench_http(args):
+    import requests
+    from GraphSession import GraphSession
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _EchoHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/submitTiIndicators'
+    request_body = {'value': [synthetic_indicator(i) for i in range(GRAPH_BATCH_SIZE)]}
+
+    start = time.perf_counter()
+    for _ in range(args.requests):
+        requests.post(url, json=request_body).json()
+    per_call_seconds = time.perf_counter() - start
+
+    session = GraphSession(1)
+    start = time.perf_counter()
+    for _ in range(args.requests):
+        session.post(url, json=request_body).json()
+    pooled_seconds = time.perf_counter() - start
+    server.shutdown()
+
+    # plain http on loopback, the TLS handshake saved against graph comes on top
+    print(f'requests:                 {args.requests}')
+    print(f'connection per call:      {per_call_seconds:.3f}s')
+    print(f'pooled keep-alive:        {pooled_seconds:.3f}s')
+
+
+def bench_e2e(args):
+    graph = MockGraph(args.latency, args.throttle_rate, args.error_rate, max_request_bytes=args.max_request_bytes)
+    misp = MockMisp(args.events, args.attributes, args.change_rate)
+    graph_url = graph.start()
+    misp_url = misp.start()
+    data_directory = tempfile.mkdtemp()
+    state_file_names = [os.path.join(data_directory, 'state.db')]
+    env = {
+        **os.environ,
+        'GRAPH_BASE_URL': graph_url,
+        'AZURE_LOGIN_URL': graph_url,
+        'MISP_BASE_URL': misp_url,
+        'MISP_KEY': 'benchmark',
+        'MISP_FETCH_MODE': args.fetch_mode,
+        'DATA_DIRECTORY': data_directory,
+        'AZ_TENANT_ID': 'benchmark',
+        'AZ_MISP_CLIENT_ID': 'benchmark',
+        'AZ_MISP_CLIENT_SECRET': 'benchmark',
+        'REPORTER': 'log',
+    }
+    if args.batch_bytes:
+        env['GRAPH_BATCH_BYTES'] = str(args.batch_bytes)
+    if args.targets > 1:
+        targets = [
+            {'name': f'tenant{i}', 'tenant': f'tenant{i}', 'client_id': 'benchmark', 'client_secret': 'benchmark'}
+            for i in range(args.targets)
+        ]
+        env['TARGETS_FILE'] = os.path.join(data_directory, 'targets.json')
+        with open(env['TARGETS_FILE'], 'w') as file:
+            json.dump(targets, file)
+        state_file_names = [os.path.join(data_directory, f'state-{target["name"]}.db') for target in targets]
+    main_file_name = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+
+    print(f'events:                   {args.events}')
+    print(f'attributes per event:     {args.attributes}')
+    print(f'targets:                  {args.targets}')
+    for run in range(1, args.runs + 1):
+        graph.stats.clear()
+        misp.stats.clear()
+        command = [sys.executable, main_file_name]
+        misp.revision = run - 1
+        if args.reconcile and run > 1:
+            # what a rerun costs after the state was lost
+            for state_file_name in state_file_names:
+                os.remove(state_file_name)
+            command.append('--reconcile')
+        start = time.perf_counter()
+        subprocess.run(command, env=env, check=True, stdout=subprocess.DEVNULL)
+        seconds = time.perf_counter() - start
+        # kilobytes on linux, the largest of the runs so far
+        peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+        stats = graph.stats
+        print(f'run {run}:')
+        print(f'  wall time:              {seconds:.3f}s')
+        print(f'  indicators submitted:   {stats["submitted_items"]}, {stats["submitted_items"] / seconds:.0f}/s')
+        print(f'  indicators updated:     {stats["updated_items"]}')
+        print(f'  indicators deleted:     {stats["deleted_items"]}')
+        print(f'  failed items:           {stats["failed_items"]}')
+        print(f'  graph calls:            {stats["graph_calls"]} ({stats["throttled_calls"]} throttled, '
+              f'{stats["too_large_calls"]} too large, {stats["token_calls"]} token)')
+        print(f'  graph bytes up/down:    {stats["bytes_received"] / 2 ** 20:.1f} / {stats["bytes_sent"] / 2 ** 20:.1f} MiB')
+        print(f'  misp calls:             {misp.stats["misp_calls"]}, {misp.stats["bytes_sent"] / 2 ** 20:.1f} MiB')
+        print(f'  peak rss:               {peak_rss / 2 ** 20:.1f} MiB')
+        with open(os.path.join(data_directory, 'run_report.json')) as file:
+            stages = json.load(file)['stages']
+        # stages nest, so these overlap
+        for stage, totals in sorted(stages.items(), key=lambda item: -item[1]['wall_seconds']):
+            print(f'  {stage + ":":<24}{totals["wall_seconds"]:.3f}s wall, {totals["cpu_seconds"]:.3f}s cpu, '
+                  f'{totals["calls"]} calls')
+    graph.stop()
+    misp.stop()
+
+
+def bench_merge(args):
+    types = sorted(MISP_ACTIONABLE_TYPES)
+
+    def parsed_events():
+        for i in range(args.events):
+            event = synthetic_event(i, args.attributes, types)
+            # every event draws its observables from a pool shared by all events
+            for j, attr in enumerate(event['Attribute'][:args.attributes]):
+                attr.update(synthetic_attribute((i * 7919 + j) % args.observables, types))
+            yield parse_event_request_bodies(event)
+
+    stats = {}
+    start = time.perf_counter()
+    sent = sum(len(request_bodies) for _, _, request_bodies in merge_parsed_events(parsed_events(), stats))
+    seconds = time.perf_counter() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    print(f'indicators parsed:        {stats["parsed"]}')
+    print(f'indicators after merge:   {sent}')
+    print(f'reduction:                {1 - sent / stats["parsed"]:.1%}')
+    print(f'parse and merge:          {seconds:.3f}s, {stats["parsed"] / seconds:.0f} indicators/s')
+    print(f'peak rss:                 {peak_rss / 2 ** 20:.1f} MiB')
+
+
+def _wait_for(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError('the daemon did not submit in time')
+        time.sleep(0.005)
+
+
+def bench_push(args):
+    graph = MockGraph(latency=args.latency)
+    misp = MockMisp(args.events, args.attributes)
+    env = {
+        **os.environ,
+        'GRAPH_BASE_URL': graph.start(),
+        'AZURE_LOGIN_URL': graph.url,
+        'MISP_BASE_URL': misp.start(),
+        'MISP_KEY': 'benchmark',
+        'DATA_DIRECTORY': tempfile.mkdtemp(),
+        'AZ_TENANT_ID': 'benchmark',
+        'AZ_MISP_CLIENT_ID': 'benchmark',
+        'AZ_MISP_CLIENT_SECRET': 'benchmark',
+        'REPORTER': 'log',
+        'PUSH_BATCH_WAIT': str(args.batch_wait),
+    }
+    if args.webhook:
+        with socket.socket() as free_port:
+            free_port.bind(('127.0.0.1', 0))
+            webhook_url = f'http://127.0.0.1:{free_port.getsockname()[1]}'
+            env['WEBHOOK_PORT'] = str(free_port.getsockname()[1])
+            env['WEBHOOK_TOKEN'] = 'benchmark'
+    else:
+        publisher = MockZmqPublisher()
+        env['MISP_ZMQ_URL'] = publisher.start()
+    main_file_name = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+    daemon = subprocess.Popen([sys.executable, main_file_name, '--daemon'], env=env, stdout=subprocess.DEVNULL)
+
+    start = time.perf_counter()
+    _wait_for(lambda: graph.stats['submitted_items'] >= args.events * args.attributes, 600)
+    print(f'initial full sync:        {time.perf_counter() - start:.3f}s, {graph.stats["submitted_items"]} indicators')
+    # the zeromq subscription is only sure to be up once the daemon did something
+    time.sleep(0.5)
+
+    types = sorted(MISP_ACTIONABLE_TYPES)
+    latencies = []
+    submit_calls = graph.stats['submit_calls']
+    for _ in range(args.pushes):
+        expected = graph.stats['submitted_items'] + args.burst * args.attributes
+        start = time.perf_counter()
+        for _ in range(args.burst):
+            event = synthetic_event(misp.events, args.attributes, types)
+            # later full syncs find the pushed event in misp too
+            misp.events += 1
+            if args.webhook:
+                request = Request(webhook_url, data=json.dumps({'Event': event}).encode('utf-8'), method='POST',
+                                  headers={'Authorization': 'benchmark'})
+                urlopen(request).read()
+            else:
+                publisher.publish_event(event)
+        _wait_for(lambda: graph.stats['submitted_items'] >= expected, 60)
+        latencies.append(time.perf_counter() - start)
+    daemon.send_signal(signal.SIGTERM)
+    daemon.wait()
+    graph.stop()
+    misp.stop()
+
+    latencies.sort()
+    print(f'pushes:                   {args.pushes} bursts of {args.burst} events, {args.burst * args.attributes} indicators')
+    print(f'push to submitted p50:    {latencies[len(latencies) // 2]:.3f}s')
+    print(f'push to submitted max:    {latencies[-1]:.3f}s')
+    print(f'submit calls per burst:   {(graph.stats["submit_calls"] - submit_calls) / args.pushes:.1f}')
+    print(f'token calls:              {graph.stats["token_calls"]}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    fingerprint_parser = subparsers.add_parser('fingerprint', help='graph calls saved by stable fingerprints')
+    fingerprint_parser.add_argument('-n', '--indicators', type=int, default=100000)
+    fingerprint_parser.set_defaults(func=bench_fingerprint)
+
+    http_parser = subparsers.add_parser('http', help='pooled keep-alive session against connection per call')
+    http_parser.add_argument('-n', '--requests', type=int, default=500)
+    http_parser.set_defaults(func=bench_http)
+
+    translate_parser = subparsers.add_parser('translate', help='translation table against per-attribute dispatch')
+    translate_parser.add_argument('-n', '--attributes', type=int, default=1000000)
+    translate_parser.set_defaults(func=bench_translate)
+
+    assemble_parser = subparsers.add_parser('assemble', help='single-pass request body assembly against copying')
+    assemble_parser.add_argument('-n', '--events', type=int, default=2000)
+    assemble_parser.add_argument('-a', '--attributes', type=int, default=100)
+    assemble_parser.set_defaults(func=bench_assemble)
+
+    parse_parser = subparsers.add_parser('parse', help='parsing scaling over worker processes')
+    parse_parser.add_argument('-n', '--events', type=int, default=2000)
+    parse_parser.add_argument('-a', '--attributes', type=int, default=100)
+    parse_parser.add_argument('-w', '--workers', type=int, default=os.cpu_count())
+    parse_parser.add_argument('-c', '--chunk-size', type=int, default=50)
+    parse_parser.set_defaults(func=bench_parse)
+
+    dump_parser = subparsers.add_parser('dump', help='streaming read of a synthetic misp json export')
+    dump_parser.add_argument('-n', '--events', type=int, default=5000)
+    dump_parser.add_argument('-a', '--attributes', type=int, default=100)
+    dump_parser.add_argument('-o', '--output', help='keep the generated export at this path')
+    dump_parser.set_defaults(func=bench_dump)
+
+    e2e_parser = subparsers.add_parser('e2e', help='main.py against local misp and graph stand-ins')
+    e2e_parser.add_argument('-n', '--events', type=int, default=200)
+    e2e_parser.add_argument('-a', '--attributes', type=int, default=100)
+    e2e_parser.add_argument('-m', '--fetch-mode', choices=('events', 'attributes'), default='events')
+    e2e_parser.add_argument('-r', '--runs', type=int, default=2, help='later runs show what an unchanged rerun costs')
+    e2e_parser.add_argument('-t', '--targets', type=int, default=1, help='tenants to fan out to')
+    e2e_parser.add_argument('--reconcile', action='store_true', help='drop the state before later runs and reconcile')
+    e2e_parser.add_argument('--change-rate', type=float, default=0.0, help='share of events changed between runs')
+    e2e_parser.add_argument('--latency', type=float, default=0.05, help='seconds graph takes per call')
+    e2e_parser.add_argument('--throttle-rate', type=float, default=0.0)
+    e2e_parser.add_argument('--error-rate', type=float, default=0.0)
+    e2e_parser.add_argument('--max-request-bytes', type=int, help='larger request bodies get a 413 from graph')
+    e2e_parser.add_argument('--batch-bytes', type=int, help='GRAPH_BATCH_BYTES of the sync')
+    e2e_parser.set_defaults(func=bench_e2e)
+
+    merge_parser = subparsers.add_parser('merge', help='cross-event merge of repeated observables')
+    merge_parser.add_argument('-n', '--events', type=int, default=2000)
+    merge_parser.add_argument('-a', '--attributes', type=int, default=100)
+    merge_parser.add_argument('-o', '--observables', type=int, default=50000, help='distinct observables')
+    merge_parser.set_defaults(func=bench_merge)
+
+    push_parser = subparsers.add_parser('push', help='daemon mode, latency from a misp push to Graph')
+    push_parser.add_argument('-n', '--events', type=int, default=20, help='events of the initial full sync')
+    push_parser.add_argument('-a', '--attributes', type=int, default=20)
+    push_parser.add_argument('-p', '--pushes', type=int, default=10)
+    push_parser.add_argument('-b', '--burst', type=int, default=5, help='events published at once per push')
+    push_parser.add_argument('--batch-wait', type=float, default=0.2, help='PUSH_BATCH_WAIT of the daemon')
+    push_parser.add_argument('--latency', type=float, default=0.05, help='seconds graph takes per call')
+    push_parser.add_argument('--webhook', action='store_true', help='push over the webhook instead of zeromq')
+    push_parser.set_defaults(func=bench_push)
+
+    internal_parser = subparsers.add_parser('_fingerprints')
+    internal_parser.add_argument('-n', '--indicators', type=int, default=100000)
+    internal_parser.set_defaults(func=_print_fingerprints)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
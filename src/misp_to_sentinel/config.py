@@ -6,14 +6,67 @@ graph_auth = {
     'client_secret': os.environ.get('AZ_MISP_CLIENT_SECRET'),
 }
 targetProduct = 'Azure Sentinel'
+# json list of tenants to submit to instead of the AZ_* one, see README
+targets_file = os.environ.get('TARGETS_FILE')
 misp_event_filters = {
     'org': '',
     'category': '',
     'timestamp': os.environ.get('MISP_EVENT_TIMEFRAME'),
 }
+# 'events' downloads whole events, 'attributes' only their actionable attributes,
+# 'dump' reads json exports and feed directories listed in MISP_DUMP_PATH
+misp_fetch_mode = os.environ.get('MISP_FETCH_MODE', 'events')
+misp_dump_paths = [path for path in os.environ.get('MISP_DUMP_PATH', '').split(os.pathsep) if path]
+# only fetch events changed since the last successful run
+misp_incremental = os.environ.get('MISP_INCREMENTAL', '').lower() in ('1', 'true', 'yes')
+misp_page_size = int(os.environ.get('MISP_PAGE_SIZE', 100))
+# merge indicators of the same observable across events into one
+merge_observables = os.environ.get('MERGE_OBSERVABLES', '').lower() in ('1', 'true', 'yes')
+# parse events in this many processes, 1 parses in the main process
+parse_workers = int(os.environ.get('PARSE_WORKERS', 1))
+parse_chunk_size = int(os.environ.get('PARSE_CHUNK_SIZE', 50))
 action = 'alert'
 passiveOnly = False
+# number of submitTiIndicators batches waiting on graph at the same time
+graph_max_in_flight = int(os.environ.get('GRAPH_MAX_IN_FLIGHT', 4))
+graph_max_retries = int(os.environ.get('GRAPH_MAX_RETRIES', 5))
+graph_base_backoff = float(os.environ.get('GRAPH_BASE_BACKOFF', 1))
+graph_max_backoff = float(os.environ.get('GRAPH_MAX_BACKOFF', 60))
+graph_gzip = os.environ.get('GRAPH_GZIP', '').lower() in ('1', 'true', 'yes')
+# a submit or update request holds up to this many indicators, 100 is what Graph takes
+graph_batch_size = int(os.environ.get('GRAPH_BATCH_SIZE', 100))
+# and up to this many bytes of json, batches Graph refuses as too large are split and sent again
+graph_batch_bytes = int(os.environ.get('GRAPH_BATCH_BYTES', 1024 * 1024))
+http_pool_size = int(os.environ.get('HTTP_POOL_SIZE', 10))
+http_timeout = float(os.environ.get('HTTP_TIMEOUT', 60))
+# refresh access tokens this many seconds before they expire
+token_refresh_margin = int(os.environ.get('TOKEN_REFRESH_MARGIN', 300))
+# keep access tokens on disk between runs, off unless set
+token_cache_file = os.environ.get('TOKEN_CACHE_FILE')
 days_to_expire = int(os.environ.get('AZ_DAYS_TO_EXPIRE'))
+# log successful submissions too, not only errors
+verbose_log = False
+log_segment_size = int(os.environ.get('LOG_SEGMENT_SIZE', 64 * 1024 * 1024))
+log_compress = os.environ.get('LOG_COMPRESS', '').lower() in ('1', 'true', 'yes')
+# segments kept per log directory, the oldest go first, 0 keeps all of them
+log_max_segments = int(os.environ.get('LOG_MAX_SEGMENTS', 100))
+# auto, tty, log or prometheus
+reporter = os.environ.get('REPORTER', 'auto')
+report_interval = float(os.environ.get('REPORT_INTERVAL', 10))
+prometheus_textfile = os.environ.get('PROMETHEUS_TEXTFILE', '/data/misp2sentinel.prom')
+# profile the run, cprofile (main thread only) or sample (all threads), off unless set
+profile = os.environ.get('PROFILE', '').lower()
+# daemon mode (main.py --daemon), seconds between full syncs
+daemon_sync_interval = float(os.environ.get('DAEMON_SYNC_INTERVAL', 3600))
+# misp zeromq feed to take published events from, e.g. tcp://misp:50000
+misp_zmq_url = os.environ.get('MISP_ZMQ_URL')
+# port to take misp webhook calls on, off unless set, it needs a WEBHOOK_TOKEN
+webhook_port = int(os.environ.get('WEBHOOK_PORT', 0))
+webhook_host = os.environ.get('WEBHOOK_HOST', '127.0.0.1')
+webhook_token = os.environ.get('WEBHOOK_TOKEN')
+# pushed messages are submitted together once this many arrived or the first waited this long
+push_batch_size = int(os.environ.get('PUSH_BATCH_SIZE', 100))
+push_batch_wait = float(os.environ.get('PUSH_BATCH_WAIT', 2))
 misp_key = os.environ.get('MISP_KEY')
 misp_domain = os.environ.get('MISP_BASE_URL')
 misp_verifycert = True
@@ -1,3 +1,5 @@
+import os
+
 ATTR_MAPPING = {
     'AS': 'networkSourceAsn',
     'email-dst': 'emailRecipient',
@@ -61,18 +63,37 @@ MISP_ACTIONABLE_TYPES = frozenset([
     *MISP_SPECIAL_CASE_TYPES
 ])
 
+# attributes that describe their event instead of being an indicator
+MISP_EVENT_CONTEXT_TYPES = frozenset([
+    'threat-actor',
+    'comment',
+])
+
 CLIENT_ID = 'client_id'
 CLIENT_SECRET = 'client_secret'
 TENANT = 'tenant'
 ACCESS_TOKEN = 'access_token'
-GRAPH_TI_INDICATORS_URL = 'https://graph.microsoft.com/beta/security/tiindicators'
+# overridable so the sync can run against local stand-ins, see mock_services.py
+GRAPH_BASE_URL = os.environ.get('GRAPH_BASE_URL', 'https://graph.microsoft.com')
+AZURE_LOGIN_URL = os.environ.get('AZURE_LOGIN_URL', 'https://login.microsoftonline.com')
+DATA_DIRECTORY = os.environ.get('DATA_DIRECTORY', '/data')
+GRAPH_TI_INDICATORS_URL = f'{GRAPH_BASE_URL}/beta/security/tiindicators'
 GRAPH_BULK_POST_URL = f'{GRAPH_TI_INDICATORS_URL}/submitTiIndicators'
 GRAPH_BULK_DEL_URL = f'{GRAPH_TI_INDICATORS_URL}/deleteTiIndicators'
-LOG_DIRECTORY_NAME = '/data/logs'
-EXISTING_INDICATORS_HASH_FILE_NAME = '/data/existing_indicators_hash.json'
+GRAPH_BULK_UPDATE_URL = f'{GRAPH_TI_INDICATORS_URL}/updateTiIndicators'
+LOG_DIRECTORY_NAME = f'{DATA_DIRECTORY}/logs'
+EXISTING_INDICATORS_HASH_FILE_NAME = f'{DATA_DIRECTORY}/existing_indicators_hash.json'
+STATE_DB_FILE_NAME = f'{DATA_DIRECTORY}/state.db'
 EXPIRATION_DATE_TIME = 'expirationDateTime'
-EXPIRATION_DATE_FILE_NAME = '/data/expiration_date.txt'
+EXPIRATION_DATE_FILE_NAME = f'{DATA_DIRECTORY}/expiration_date.txt'
+RUN_REPORT_FILE_NAME = f'{DATA_DIRECTORY}/run_report.json'
+CPROFILE_FILE_NAME = f'{DATA_DIRECTORY}/profile.pstats'
+SAMPLE_PROFILE_FILE_NAME = f'{DATA_DIRECTORY}/profile.folded'
 INDICATOR_REQUEST_HASH = 'indicatorRequestHash'
+# (misp attribute type, value) an indicator was translated from, never fingerprinted nor sent to Graph
+MISP_OBSERVABLE = 'mispObservable'
+# Graph takes descriptions of up to 100 characters
+GRAPH_DESCRIPTION_MAX_LENGTH = 100
 # TARGET_PRODUCT_BULK_SUPPORT = ['Azure Sentinel']
 # TARGET_PRODUCT_NON_BULK_SUPPORT = ['Microsoft Defender ATP']
 
@@ -107,6 +128,28 @@ OPTIONAL_GRAPH_METADATA = frozenset([
     "tags",
 ])
 
+# fields updateTiIndicators can change, anything else takes a resubmit. indicatorRequestHash is not
+# one of them, an indicator updated in place keeps its old hash in Graph and gets the new one only in the state
+UPDATABLE_GRAPH_FIELDS = frozenset([
+    "action",
+    "activityGroupNames",
+    "additionalInformation",
+    "confidence",
+    "description",
+    "diamondModel",
+    "expirationDateTime",
+    "externalId",
+    "isActive",
+    "killChain",
+    "knownFalsePositives",
+    "lastReportedDateTime",
+    "malwareFamilyNames",
+    "passiveOnly",
+    "severity",
+    "tags",
+    "tlpLevel",
+])
+
 GRAPH_OBSERVABLES = frozenset([
     "emailEncoding",
     "emailLanguage",
@@ -0,0 +1,97 @@
+import gzip
+import json
+import os
+import re
+
+CHUNK_SIZE = 1024 * 1024
+
+_WHITESPACE_RE = re.compile(r'[\s,]*')
+_RESPONSE_ARRAY_RE = re.compile(r'\{\s*"response"\s*:\s*\[')
+
+
+def _open(file_name):
+    if file_name.endswith('.gz'):
+        return gzip.open(file_name, 'rt', encoding='utf-8')
+    return open(file_name, encoding='utf-8')
+
+
+def _iter_json_array(file, buffer):
+    """Yields the elements of a json array one by one, reading the file as needed.
+
+    buffer holds what was already read, starting right after the opening '['.
+    Only a single element is ever decoded at a time, so memory is bounded by
+    the largest element rather than by the file.
+    """
+    decoder = json.JSONDecoder()
+    position = 0
+    eof = False
+    while True:
+        position = _WHITESPACE_RE.match(buffer, position).end()
+        if position < len(buffer) and buffer[position] == ']':
+            return
+        try:
+            element, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            element = None
+        # an element ending at the buffer edge may be a truncated number, read on
+        if element is None or end == len(buffer) and not eof:
+            chunk = file.read(CHUNK_SIZE)
+            eof = chunk == ''
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        yield element
+        position = end
+
+
+def read_dump_file(file_name):
+    """Yields the events in a misp json export.
+
+    Supported are restSearch exports ({"response": [...]}), plain arrays of
+    events and files holding a single event, like the events of a feed.
+    """
+    with _open(file_name) as file:
+        buffer = file.read(CHUNK_SIZE)
+        # enough to tell the formats apart
+        while len(buffer.lstrip()) < 64:
+            chunk = file.read(CHUNK_SIZE)
+            if chunk == '':
+                break
+            buffer += chunk
+        start = buffer.lstrip()
+        response_array = _RESPONSE_ARRAY_RE.match(start)
+        if response_array:
+            elements = _iter_json_array(file, start[response_array.end():])
+        elif start.startswith('['):
+            elements = _iter_json_array(file, start[1:])
+        else:
+            elements = [json.loads(buffer + file.read())]
+        for element in elements:
+            yield element.get('Event', element)
+
+
+def read_feed_directory(directory):
+    """Yields the events of a misp feed directory, in manifest order if there is one."""
+    manifest_file_name = os.path.join(directory, 'manifest.json')
+    if os.path.exists(manifest_file_name):
+        with open(manifest_file_name, encoding='utf-8') as file:
+            event_uuids = list(json.load(file))
+        file_names = [os.path.join(directory, f'{event_uuid}.json') for event_uuid in event_uuids]
+    else:
+        file_names = sorted(
+            os.path.join(directory, file_name) for file_name in os.listdir(directory)
+            if file_name.endswith(('.json', '.json.gz'))
+        )
+    for file_name in file_names:
+        yield from read_dump_file(file_name)
+
+
+def read_dump(paths):
+    """Yields the events of misp json exports and feed directories, one at a time."""
+    for path in paths:
+        if os.path.isdir(path):
+            yield from read_feed_directory(path)
+        else:
+            yield from read_dump_file(path)
@@ -0,0 +1,88 @@
+import hashlib
+import json
+import re
+
+from constants import INDICATOR_REQUEST_HASH, MISP_OBSERVABLE
+
+# fields that change on every run without the indicator itself changing
+VOLATILE_FIELDS = frozenset([
+    'expirationDateTime',
+    'lastReportedDateTime',
+    'indicatorRequestHash',
+])
+
+# fields left out of the fingerprint
+_UNFINGERPRINTED_FIELDS = VOLATILE_FIELDS | {MISP_OBSERVABLE}
+
+FINGERPRINT_DIGEST_SIZE = 16
+
+# older versions stored str(hash(frozenset(...))), a signed decimal that
+# differs per interpreter because of PYTHONHASHSEED
+_LEGACY_FINGERPRINT_RE = re.compile(r'^-?\d{1,20}$')
+
+
+def canonical_indicator(indicator):
+    """Serializes the stable part of an indicator to canonical JSON bytes.
+
+    Keys are sorted and whitespace is stripped so the same indicator always
+    produces the same bytes, regardless of dict insertion order or process.
+    """
+    return json.dumps(
+        {k: v for k, v in indicator.items() if k not in _UNFINGERPRINTED_FIELDS},
+        sort_keys=True,
+        separators=(',', ':'),
+        ensure_ascii=False,
+        default=str,
+    ).encode('utf-8')
+
+
+def get_fingerprint(indicator):
+    """Returns a deterministic hex fingerprint for an indicator request body."""
+    return hashlib.blake2b(canonical_indicator(indicator), digest_size=FINGERPRINT_DIGEST_SIZE).hexdigest()
+
+
+def get_stable_fingerprint(indicator):
+    """Same as get_fingerprint, for a body known to hold no volatile fields yet."""
+    canonical = json.dumps(indicator, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str)
+    return hashlib.blake2b(canonical.encode('utf-8'), digest_size=FINGERPRINT_DIGEST_SIZE).hexdigest()
+
+
+def get_observable_key(request_body):
+    """Returns a digest of the misp attribute type and value a request body was translated from.
+
+    A body that does not carry them only ever matches itself, by its fingerprint.
+    """
+    observable = request_body.get(MISP_OBSERVABLE)
+    if not observable:
+        return bytes.fromhex(request_body.get(INDICATOR_REQUEST_HASH) or get_fingerprint(request_body))
+    return hashlib.blake2b(repr(tuple(observable)).encode('utf-8'), digest_size=FINGERPRINT_DIGEST_SIZE).digest()
+
+
+def get_identity(request_body, event_id):
+    """Returns what identifies an indicator across changes, its misp attribute type and value and its event.
+
+    Unlike the fingerprint it stays the same when tags, descriptions or other
+    metadata change, so a changed indicator can be updated in place.
+    """
+    identity = get_observable_key(request_body) + str(event_id).encode('utf-8')
+    return hashlib.blake2b(identity, digest_size=FINGERPRINT_DIGEST_SIZE).digest()
+
+
+def is_legacy_fingerprint(fingerprint):
+    return _LEGACY_FINGERPRINT_RE.match(fingerprint) is not None
+
+
+def split_legacy_fingerprints(existing_indicators_hash):
+    """Splits a fingerprint -> indicator id map into (current, legacy) maps.
+
+    Legacy fingerprints can never match again, so their indicators are
+    resubmitted once under a stable fingerprint and the old ids deleted.
+    """
+    current = {}
+    legacy = {}
+    for fingerprint, indicator_id in existing_indicators_hash.items():
+        if is_legacy_fingerprint(fingerprint):
+            legacy[fingerprint] = indicator_id
+        else:
+            current[fingerprint] = indicator_id
+    return current, legacy
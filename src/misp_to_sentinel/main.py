@@ -1,106 +1,249 @@
-from pymisp import PyMISP
 from pymisp import ExpandedPyMISP
 import config
 from collections import defaultdict
-import datetime
 from RequestManager import RequestManager
-from RequestObject import RequestObject
+from FanOut import FanOut
+from Daemon import Daemon
+from Target import get_targets
+from translation import parse_event_request_bodies
+from parallel_parse import parse_events_in_processes
+from merge import merge_parsed_events
+from dump_reader import read_dump
+from RunReport import run_report, SamplingProfiler
 from constants import *
 import sys
-from functools import reduce
-import os
-
-def _get_events():
-    misp = ExpandedPyMISP(config.misp_domain, config.misp_key, config.misp_verifycert)
-    if len(config.misp_event_filters) == 0:
-        return [event['Event'] for event in misp.search(controller='events', return_format='json')]
-    events_for_each_filter = [
-        [event['Event'] for event in misp.search(controller='events', return_format='json', **config.misp_event_filters)]
-    ]
-    event_ids_for_each_filter = [set(event['id'] for event in events) for events in events_for_each_filter]
-    event_ids_intersection = reduce((lambda x, y: x & y), event_ids_for_each_filter)
-    return [event for event in events_for_each_filter[0] if event['id'] in event_ids_intersection]
-
-
-def _graph_post_request_body_generator(parsed_events):
-    for event in parsed_events:
-        request_body_metadata = {
-            **{field: event[field] for field in REQUIRED_GRAPH_METADATA},
-            **{field: event[field] for field in OPTIONAL_GRAPH_METADATA if field in event},
-            'action': config.action,
-            'passiveOnly': config.passiveOnly,
-            'threatType': 'watchlist',
-            'targetProduct': config.targetProduct,
-        }
-        for request_object in event['request_objects']:
-            request_body = {
-                **request_body_metadata.copy(),
-                **request_object.__dict__,
-                'tags': request_body_metadata.copy()['tags'] + request_object.__dict__['tags']
-            }
-            yield request_body
-
-
-def _handle_timestamp(parsed_event):
-    parsed_event['lastReportedDateTime'] = str(
-        datetime.datetime.fromtimestamp(int(parsed_event['lastReportedDateTime'])))
-
-
-def _handle_diamond_model(parsed_event):
-    for tag in parsed_event['tags']:
-        if 'diamond-model:' in tag:
-            parsed_event['diamondModel'] = tag.split(':')[1]
-
-
-def _handle_tlp_level(parsed_event):
-    for tag in parsed_event['tags']:
-        if 'tlp:' in tag:
-            tlpLevel = str(tag.split(':')[1]).lower()
-            if tlpLevel not in ['unknown','white','green','amber','red']:
+import signal
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def _get_misp():
+    # one client, and so one pooled keep-alive session, for all misp traffic
+    return ExpandedPyMISP(config.misp_domain, config.misp_key, config.misp_verifycert, timeout=config.http_timeout)
+
+
+def _get_event_filters(high_water_mark):
+    if high_water_mark is None:
+        return config.misp_event_filters
+    # deleted attributes are fetched too, so an event whose last indicator was
+    # deleted still shows up and its indicators get removed
+    return {**config.misp_event_filters, 'timestamp': high_water_mark, 'deleted': [0, 1]}
+
+
+def _get_events(filters):
+    """Yields events from misp one page at a time so only a page is held in memory."""
+    misp = _get_misp()
+    page = 1
+    while True:
+        events = misp.search(
+            controller='events',
+            return_format='json',
+            page=page,
+            limit=config.misp_page_size,
+            **filters,
+        )
+        for event in events:
+            yield event['Event']
+        if len(events) < config.misp_page_size:
+            return
+        page += 1
+
+
+def _get_event_metadata(misp, event_id):
+    """Returns an event without its attributes, except the ones describing the event itself."""
+    events = misp.search(controller='events', return_format='json', eventid=event_id, metadata=True)
+    if len(events) == 0:
+        return None
+    event = events[0]['Event']
+    event['Attribute'] = misp.search(
+        controller='attributes',
+        return_format='json',
+        eventid=event_id,
+        type_attribute=list(MISP_EVENT_CONTEXT_TYPES),
+    ).get('Attribute', [])
+    return event
+
+
+def _get_attributes(filters):
+    """Yields events holding only their actionable attributes, filtered by misp itself.
+
+    Attributes are fetched a page at a time, event metadata once per event id.
+    An event spanning several pages is yielded once per page.
+    """
+    misp = _get_misp()
+    # the event timeframe must apply to events, not to the attributes in them
+    filters = {
+        ('event_timestamp' if key == 'timestamp' else key): value
+        for key, value in filters.items()
+    }
+    event_metadata = {}
+    page = 1
+    while True:
+        attributes = misp.search(
+            controller='attributes',
+            return_format='json',
+            type_attribute=list(MISP_ACTIONABLE_TYPES),
+            page=page,
+            limit=config.misp_page_size,
+            **filters,
+        ).get('Attribute', [])
+        attributes_by_event = defaultdict(list)
+        for attr in attributes:
+            attributes_by_event[attr['event_id']].append(attr)
+        for event_id, event_attributes in attributes_by_event.items():
+            if event_id not in event_metadata:
+                event_metadata[event_id] = _get_event_metadata(misp, event_id)
+            event = event_metadata[event_id]
+            if event is None:
                 continue
-            parsed_event['tlpLevel'] = tlpLevel
-
-    if 'tlpLevel' not in parsed_event:
-        parsed_event['tlpLevel'] = 'unknown'
+            yield {**event, 'Attribute': event['Attribute'] + event_attributes}
+        if len(attributes) < config.misp_page_size:
+            return
+        page += 1
+
+
+def _get_dump_events(high_water_mark):
+    """Yields events from local misp exports or feed directories instead of a misp server."""
+    for event in read_dump(config.misp_dump_paths):
+        if high_water_mark is None or int(event['timestamp']) >= int(high_water_mark):
+            yield event
+
+
+def _parse_event_stream(events):
+    """Yields (event id, event timestamp, request bodies) for every event, in order."""
+    if config.parse_workers > 1:
+        yield from parse_events_in_processes(events, config.parse_workers, config.parse_chunk_size)
+    else:
+        for event in events:
+            yield parse_event_request_bodies(event)
+
+
+def _get_pushed_event_ids(messages):
+    """Returns the ids of the events messages pushed by misp are about, each once and in order."""
+    event_ids = {}
+    for message in messages:
+        if isinstance(message.get('Attribute'), dict):
+            event_id = message['Attribute'].get('event_id')
+        elif isinstance(message.get('Event'), dict):
+            event_id = message['Event'].get('id') or message['Event'].get('uuid')
+        else:
+            continue
+        if event_id:
+            event_ids[str(event_id)] = None
+    return list(event_ids)
+
+
+def _get_pushed_events(messages):
+    """Yields the events misp pushed changes of, fetched anew from misp.
+
+    A push only says which event changed. Its body is never submitted, it is
+    not authenticated by misp and could carry anything.
+    """
+    misp = _get_misp()
+    for event_id in _get_pushed_event_ids(messages):
+        events = misp.search(controller='events', return_format='json', eventid=event_id)
+        if events:
+            yield events[0]['Event']
+
+
+def _push(messages):
+    """Submits what misp pushed, deleting is left to the next full sync."""
+    with FanOut(get_targets(), partial=True) as fan_out:
+        for event in _get_pushed_events(messages):
+            fan_out.put(*parse_event_request_bodies(event))
+
+
+def _sync(reconcile=False):
+    run_report.reset()
+    try:
+        _sync_targets(reconcile)
+    finally:
+        # written for failed runs too, they are the ones worth a look
+        run_report.write(RUN_REPORT_FILE_NAME)
+
+
+def _check_merge_config(daemon=False):
+    if not config.merge_observables:
+        return
+    # a merged body rebuilt from part of misp would be updated over the complete one
+    if config.misp_incremental:
+        raise ValueError('MERGE_OBSERVABLES cannot be combined with MISP_INCREMENTAL')
+    if daemon and (config.misp_zmq_url or config.webhook_port):
+        raise ValueError('MERGE_OBSERVABLES cannot be combined with MISP_ZMQ_URL or WEBHOOK_PORT')
+
+
+def _sync_targets(reconcile):
+    print('fetching & parsing data from misp...')
+    with FanOut(get_targets(), reconcile=reconcile) as fan_out:
+        high_water_mark = fan_out.high_water_mark
+        filters = _get_event_filters(high_water_mark)
+        if config.misp_fetch_mode == 'dump':
+            events = _get_dump_events(high_water_mark)
+        elif config.misp_fetch_mode == 'attributes':
+            events = _get_attributes(filters)
+        else:
+            events = _get_events(filters)
+        parsed_events = _parse_event_stream(run_report.timed('misp_fetch', events))
+        merge_stats = {}
+        if config.merge_observables:
+            parsed_events = merge_parsed_events(parsed_events, merge_stats)
+        # misp is fetched and parsed once, every target gets the same stream
+        for event_id, timestamp, request_bodies in parsed_events:
+            run_report.count('events')
+            run_report.count('request_bodies', len(request_bodies))
+            # time spent here is time waiting for the slowest target
+            with run_report.time('fan_out_put'):
+                fan_out.put(event_id, timestamp, request_bodies)
+    for name, count in merge_stats.items():
+        run_report.count(f'merge_{name}', count)
+    if merge_stats.get('parsed'):
+        print(f"merged {merge_stats['parsed']} indicators into {merge_stats['merged']}, "
+              f"{1 - merge_stats['merged'] / merge_stats['parsed']:.1%} fewer", flush=True)
+
+
+def _run_daemon(reconcile=False):
+    def sync():
+        nonlocal reconcile
+        _sync(reconcile)
+        # only the first successful sync reconciles
+        reconcile = False
+
+    daemon = Daemon(sync, _push)
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+    daemon.run()
+
+
+def _run_profiled(job, *args):
+    if config.profile == 'cprofile':
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(job, *args)
+        finally:
+            profiler.dump_stats(CPROFILE_FILE_NAME)
+    elif config.profile == 'sample':
+        profiler = SamplingProfiler()
+        profiler.start()
+        try:
+            job(*args)
+        finally:
+            profiler.stop(SAMPLE_PROFILE_FILE_NAME)
+    else:
+        job(*args)
 
 
 def main():
     if '-r' in sys.argv:
-        RequestManager.read_tiindicators()
+        for target in get_targets():
+            RequestManager.read_tiindicators(target)
         sys.exit()
     config.verbose_log = ('-v' in sys.argv)
-    print('fetching & parsing data from misp...')
-    events = _get_events()
-    parsed_events = list()
-    for event in events:
-        parsed_event = defaultdict(list)
-
-        for key, mapping in EVENT_MAPPING.items():
-            parsed_event[mapping] = event.get(key, "")
-        parsed_event['tags'] = [tag['name'].strip() for tag in event.get("Tag", [])]
-        _handle_diamond_model(parsed_event)
-        _handle_tlp_level(parsed_event)
-        _handle_timestamp(parsed_event)
-
-        for attr in event['Attribute']:
-            if attr['type'] == 'threat-actor':
-                parsed_event['activityGroupNames'].append(attr['value'])
-            if attr['type'] == 'comment':
-                parsed_event['description'] += attr['value']
-            if attr['type'] in MISP_ACTIONABLE_TYPES:
-                parsed_event['request_objects'].append(RequestObject(attr))
-
-        parsed_events.append(parsed_event)
-    del events
-
-    total_indicators = sum([len(v['request_objects']) for v in parsed_events])
-    with RequestManager(total_indicators) as request_manager:
-        for request_body in _graph_post_request_body_generator(parsed_events):
-            #print(f"request body: {request_body}")
-            request_manager.handle_indicator(request_body)
-
-    RequestManager.delete_old_indicators()
+    _check_merge_config(daemon='--daemon' in sys.argv)
+    if '--daemon' in sys.argv:
+        _run_profiled(_run_daemon, '--reconcile' in sys.argv)
+    else:
+        _run_profiled(_sync, '--reconcile' in sys.argv)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,108 @@
+import pickle
+import sqlite3
+
+from constants import *
+from fingerprint import get_fingerprint, get_observable_key
+
+# page cache of the merge index, the rest of it stays on disk
+MERGE_CACHE_KIB = 64 * 1024
+
+TLP_LEVEL_ORDER = {'unknown': 0, 'white': 1, 'green': 2, 'amber': 3, 'red': 4}
+
+
+def _union(first, second):
+    return first + [item for item in second if item not in first]
+
+
+def _is_newer(request_body, merged):
+    return request_body.get('lastReportedDateTime', '') > merged.get('lastReportedDateTime', '')
+
+
+def _merge_descriptions(merged_description, description):
+    descriptions = merged_description.split('\n')
+    for line in description.split('\n'):
+        if line not in descriptions:
+            descriptions.append(line)
+    # an observable common to many events must not grow its description without end
+    return '\n'.join(descriptions)[:GRAPH_DESCRIPTION_MAX_LENGTH]
+
+
+def merge_request_bodies(merged, request_body):
+    """Merges two request bodies of the same observable into a new one.
+
+    Tags, activity group names and descriptions are combined, descriptions
+    without repeats and cut to what Graph takes, the highest TLP level wins. Everything else comes from the more recently reported of
+    the two, and so does lastReportedDateTime.
+    """
+    result = dict(request_body if _is_newer(request_body, merged) else merged)
+    result['tags'] = _union(merged['tags'], request_body['tags'])
+    activity_group_names = _union(merged.get('activityGroupNames', []), request_body.get('activityGroupNames', []))
+    if activity_group_names:
+        result['activityGroupNames'] = activity_group_names
+    result['description'] = _merge_descriptions(merged['description'], request_body['description'])
+    result['tlpLevel'] = max(
+        merged['tlpLevel'], request_body['tlpLevel'], key=lambda level: TLP_LEVEL_ORDER.get(level, 0))
+    return result
+
+
+def merge_parsed_events(parsed_events, stats):
+    """Merges the indicators of an observable that shows up in several events into one.
+
+    Takes and yields (event id, event timestamp, request bodies). Every event
+    passes through at once without its bodies, so it is still recorded as
+    fetched. Once the stream is exhausted the merged bodies follow, grouped by
+    the event they were last reported in. Merged ones get their fingerprint
+    taken again, the others are yielded as they came.
+
+    The index lives in a temporary on-disk SQLite database, only its page
+    cache is held in memory however many observables there are. stats gets
+    the number of indicators parsed and the number of merged ones.
+
+    A merged body is only complete when the stream holds every event, so
+    incremental and pushed runs must not merge.
+    """
+    connection = sqlite3.connect('')
+    connection.execute(f'PRAGMA cache_size = -{MERGE_CACHE_KIB}')
+    try:
+        connection.execute(
+            'CREATE TABLE merged ('
+            'observable BLOB PRIMARY KEY, event_id TEXT, timestamp INTEGER, body BLOB, occurrences INTEGER)')
+        parsed_count = 0
+        for event_id, timestamp, request_bodies in parsed_events:
+            for request_body in request_bodies:
+                parsed_count += 1
+                observable = get_observable_key(request_body)
+                row = connection.execute(
+                    'SELECT event_id, timestamp, body FROM merged WHERE observable = ?', (observable,)).fetchone()
+                if row is None:
+                    connection.execute(
+                        'INSERT INTO merged (observable, event_id, timestamp, body, occurrences) VALUES (?, ?, ?, ?, 1)',
+                        (observable, event_id, timestamp, pickle.dumps(request_body, pickle.HIGHEST_PROTOCOL)))
+                    continue
+                merged = pickle.loads(row[2])
+                if _is_newer(request_body, merged):
+                    row = (event_id, timestamp)
+                connection.execute(
+                    'UPDATE merged SET event_id = ?, timestamp = ?, body = ?, occurrences = occurrences + 1 '
+                    'WHERE observable = ?',
+                    (row[0], row[1], pickle.dumps(merge_request_bodies(merged, request_body), pickle.HIGHEST_PROTOCOL), observable))
+            yield event_id, timestamp, []
+        connection.execute('CREATE INDEX merged_event_id ON merged (event_id)')
+        stats['parsed'] = parsed_count
+        stats['merged'] = 0
+        group_event_id, group_timestamp, group = None, None, []
+        for event_id, timestamp, body, occurrences in connection.execute(
+                'SELECT event_id, timestamp, body, occurrences FROM merged ORDER BY event_id'):
+            if event_id != group_event_id and group:
+                yield group_event_id, group_timestamp, group
+                group = []
+            request_body = pickle.loads(body)
+            if occurrences > 1:
+                request_body[INDICATOR_REQUEST_HASH] = get_fingerprint(request_body)
+            group_event_id, group_timestamp = event_id, timestamp
+            group.append(request_body)
+            stats['merged'] += 1
+        if group:
+            yield group_event_id, group_timestamp, group
+    finally:
+        connection.close()
@@ -0,0 +1,343 @@
+"""Local stand-ins for MISP, login.microsoftonline.com and the Graph tiIndicators API.
+
+Both serve plain http on 127.0.0.1 and are meant for benchmarks and manual
+testing. Point the sync at them with MISP_BASE_URL, GRAPH_BASE_URL and
+AZURE_LOGIN_URL, see 'benchmark.py e2e'.
+"""
+import gzip
+import json
+import random
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+from constants import *
+
+_SYNTHETIC_VALUES = {
+    'ip-dst': lambda i: f'10.0.{(i >> 8) & 255}.{i & 255}',
+    'ip-src': lambda i: f'2001:db8::{i:x}',
+    'ip-dst|port': lambda i: f'10.1.{(i >> 8) & 255}.{i & 255}|{i % 65535}',
+    'ip-src|port': lambda i: f'2001:db8::{i:x}|{i % 65535}',
+    'domain|ip': lambda i: f'host{i}.example.com|10.2.{(i >> 8) & 255}.{i & 255}',
+    'email-src': lambda i: f'user{i}@example.com',
+}
+
+SYNTHETIC_BASE_TIMESTAMP = 1672531200
+
+
+def synthetic_attribute(i, types):
+    attr_type = types[i % len(types)]
+    if attr_type in _SYNTHETIC_VALUES:
+        value = _SYNTHETIC_VALUES[attr_type](i)
+    elif attr_type.startswith('filename|'):
+        value = f'file{i}.exe|{i:040x}'
+    else:
+        value = f'{i:040x}'
+    tags = [{'name': f'campaign:{i % 7}'}]
+    if i % 5 == 0:
+        tags.append({'name': 'diamond-model:Infrastructure'})
+    return {'type': attr_type, 'value': value, 'uuid': f'{i:032x}', 'Tag': tags}
+
+
+def synthetic_event(i, attributes_per_event, types):
+    """Returns a misp event as the events controller returns it."""
+    attributes = [synthetic_attribute(i * attributes_per_event + j, types) for j in range(attributes_per_event)]
+    attributes.append({'type': 'threat-actor', 'value': 'APT', 'uuid': f'{i:032x}', 'Tag': []})
+    attributes.append({'type': 'comment', 'value': ' synthetic comment', 'uuid': f'{i:032x}', 'Tag': []})
+    for attr in attributes:
+        attr['event_id'] = str(i)
+    return {
+        'id': str(i),
+        'uuid': f'{i:032x}',
+        'info': f'synthetic event {i}',
+        'date': '2023-01-01',
+        'timestamp': str(SYNTHETIC_BASE_TIMESTAMP + i),
+        'Tag': [{'name': 'tlp:amber'}, {'name': f'campaign:{i % 7}'}, {'name': 'diamond-model:Capability'}],
+        'Attribute': attributes,
+    }
+
+
+class _JsonHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def _read_json(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.service.count('bytes_received', len(body))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        if not body:
+            return {}
+        if self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+            return {key: values[0] for key, values in parse_qs(body.decode('utf-8')).items()}
+        return json.loads(body)
+
+    def _send_json(self, status, response, headers=None):
+        body = json.dumps(response).encode('utf-8')
+        self.server.service.count('bytes_sent', len(body))
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.service.handle(self, 'GET')
+
+    def do_POST(self):
+        self.server.service.handle(self, 'POST')
+
+    def log_message(self, *args):
+        pass
+
+
+class _MockService:
+    def __init__(self):
+        self.stats = Counter()
+        self.stats_lock = threading.Lock()
+        self.server = None
+
+    def count(self, name, amount=1):
+        with self.stats_lock:
+            self.stats[name] += amount
+
+    def start(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _JsonHandler)
+        self.server.daemon_threads = True
+        self.server.service = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_port}'
+
+    def handle(self, handler, method):
+        raise NotImplementedError
+
+
+class MockGraph(_MockService):
+    """Stands in for the token endpoint and the Graph tiIndicators API
+
+    Implements submitTiIndicators, updateTiIndicators, deleteTiIndicators and the filtered, paged
+    GET on tiindicators, every tenant seeing only its own indicators, with a fixed latency per call, a share of calls
+    throttled with 429 and Retry-After, and a share of items failing. Request bodies over max_request_bytes are refused
+    with 413.
+    """
+
+    def __init__(self, latency=0.0, throttle_rate=0.0, error_rate=0.0, page_size=100, retry_after=1, seed=0,
+                 max_request_bytes=None):
+        super().__init__()
+        self.max_request_bytes = max_request_bytes
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.page_size = page_size
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.indicators = defaultdict(dict)
+        self.lock = threading.Lock()
+
+    def handle(self, handler, method):
+        path = urlparse(handler.path).path
+        request_body = handler._read_json() if method == 'POST' else {}
+        if path.endswith('/oauth2/v2.0/token'):
+            self.count('token_calls')
+            # the token names its tenant, like the tid claim of a real one
+            tenant = path.split('/')[1]
+            handler._send_json(200, {ACCESS_TOKEN: f'{tenant}.{uuid.uuid4().hex}', 'expires_in': 3599})
+            return
+        indicators = self.indicators[handler.headers.get('Authorization', '').rpartition(' ')[2].partition('.')[0]]
+        self.count('graph_calls')
+        time.sleep(self.latency)
+        with self.lock:
+            throttled = self.random.random() < self.throttle_rate
+        if throttled:
+            self.count('throttled_calls')
+            handler._send_json(429, {'error': {'code': 'TooManyRequests'}}, {'Retry-After': str(self.retry_after)})
+        elif self.max_request_bytes and int(handler.headers.get('Content-Length', 0)) > self.max_request_bytes:
+            self.count('too_large_calls')
+            handler._send_json(413, {'error': {'code': 'RequestEntityTooLarge'}})
+        elif path.endswith('/submitTiIndicators'):
+            self.count('submit_calls')
+            handler._send_json(200, {'value': [self._submit(indicators, indicator) for indicator in request_body['value']]})
+        elif path.endswith('/updateTiIndicators'):
+            self.count('update_calls')
+            handler._send_json(200, {'value': [self._update(indicators, update) for update in request_body['value']]})
+        elif path.endswith('/deleteTiIndicators'):
+            self.count('delete_calls')
+            handler._send_json(200, {'value': [self._delete(indicators, indicator_id) for indicator_id in request_body['value']]})
+        elif path.endswith('/tiindicators') and method == 'GET':
+            self.count('list_calls')
+            handler._send_json(200, self._list(indicators, handler.path))
+        else:
+            handler._send_json(404, {'error': {'code': 'NotFound', 'message': path}})
+
+    def _submit(self, indicators, indicator):
+        with self.lock:
+            failed = self.random.random() < self.error_rate
+            if not failed:
+                indicator = {**indicator, 'id': uuid.uuid4().hex}
+                indicators[indicator['id']] = indicator
+        if failed:
+            self.count('failed_items')
+            return {INDICATOR_REQUEST_HASH: indicator.get(INDICATOR_REQUEST_HASH), 'Error': {'code': 'BadRequest'}}
+        self.count('submitted_items')
+        return indicator
+
+    def _update(self, indicators, update):
+        with self.lock:
+            indicator = indicators.get(update['id'])
+            if indicator is not None:
+                indicator.update(update)
+        if indicator is None:
+            self.count('failed_items')
+            return {'id': update['id'], 'Error': {'code': 'NotFound'}}
+        self.count('updated_items')
+        return {'id': update['id']}
+
+    def _delete(self, indicators, indicator_id):
+        with self.lock:
+            found = indicators.pop(indicator_id, None) is not None
+        self.count('deleted_items')
+        return {'id': indicator_id, 'status': 204 if found else 404}
+
+    def _list(self, indicators, raw_path):
+        query = parse_qs(urlparse(raw_path).query)
+        skip = int(query.get('$skiptoken', ['0'])[0])
+        with self.lock:
+            indicators = list(indicators.values())
+        # only the expiration filter the sync itself sends is understood
+        expression = query.get('$filter', [''])[0]
+        if expression.startswith('expirationDateTime lt '):
+            before = expression[len('expirationDateTime lt '):]
+            indicators = [i for i in indicators if str(i.get(EXPIRATION_DATE_TIME, '')) < before]
+        page = indicators[skip:skip + self.page_size]
+        select = query.get('$select', [''])[0]
+        if select:
+            fields = select.split(',')
+            page = [{field: indicator.get(field) for field in fields} for indicator in page]
+        response = {'value': page}
+        if skip + self.page_size < len(indicators):
+            next_query = {key: values[0] for key, values in query.items()}
+            next_query['$skiptoken'] = str(skip + self.page_size)
+            response['@odata.nextLink'] = f'{self.url}{urlparse(raw_path).path}?{urlencode(next_query)}'
+        return response
+
+
+class MockMisp(_MockService):
+    """Stands in for the MISP restSearch API, serving synthetic events at a chosen scale
+
+    Events are generated on request, so the scale costs no memory. Raising
+    revision tags a change_rate share of the events anew, like analysts
+    editing events between runs.
+    """
+
+    def __init__(self, events, attributes_per_event, change_rate=0.0):
+        super().__init__()
+        self.events = events
+        self.attributes_per_event = attributes_per_event
+        self.change_rate = change_rate
+        self.revision = 0
+        self.types = sorted(MISP_ACTIONABLE_TYPES)
+
+    def handle(self, handler, method):
+        path = urlparse(handler.path).path.strip('/')
+        request_body = handler._read_json() if method == 'POST' else {}
+        self.count('misp_calls')
+        if path.startswith('servers/get'):
+            handler._send_json(200, {'version': '2.4.0'})
+        elif path.startswith('users/view/'):
+            # pymisp looks up the key owner when it connects
+            handler._send_json(200, {'User': {'id': '1', 'email': 'benchmark@example.com'},
+                                     'Role': {'id': '1', 'name': 'benchmark'}, 'UserSetting': {}})
+        elif path == 'events/restSearch':
+            handler._send_json(200, {'response': self._search_events(request_body)})
+        elif path == 'attributes/restSearch':
+            handler._send_json(200, {'response': {'Attribute': self._search_attributes(request_body)}})
+        else:
+            handler._send_json(200, {})
+
+    def _first_event(self, request_body, timestamp_key):
+        timestamp = request_body.get(timestamp_key)
+        if isinstance(timestamp, int) or isinstance(timestamp, str) and timestamp.isdigit():
+            return min(self.events, max(0, int(timestamp) - SYNTHETIC_BASE_TIMESTAMP))
+        return 0
+
+    @staticmethod
+    def _page(request_body, total):
+        limit = int(request_body.get('limit', total))
+        start = (int(request_body.get('page', 1)) - 1) * limit
+        return range(start, min(total, start + limit))
+
+    def _get_event(self, event_id):
+        event = synthetic_event(event_id, self.attributes_per_event, self.types)
+        if self.revision and event_id % 100 < self.change_rate * 100:
+            event['Tag'].append({'name': f'revision:{self.revision}'})
+        return event
+
+    def _search_events(self, request_body):
+        if 'eventid' in request_body:
+            event_ids = [int(request_body['eventid'])]
+        else:
+            first = self._first_event(request_body, 'timestamp')
+            event_ids = [first + i for i in self._page(request_body, self.events - first)]
+        events = []
+        for event_id in event_ids:
+            event = self._get_event(event_id)
+            if request_body.get('metadata'):
+                del event['Attribute']
+            events.append({'Event': event})
+        return events
+
+    def _search_attributes(self, request_body):
+        types = request_body.get('type')
+        if 'eventid' in request_body:
+            event = self._get_event(int(request_body['eventid']))
+            return [attr for attr in event['Attribute'] if types is None or attr['type'] in types]
+        # without an event id only the actionable attributes the sync asks for are served
+        first = self._first_event(request_body, 'event_timestamp')
+        offset = first * self.attributes_per_event
+        attributes = []
+        for i in self._page(request_body, (self.events - first) * self.attributes_per_event):
+            attr = synthetic_attribute(offset + i, self.types)
+            attr['event_id'] = str((offset + i) // self.attributes_per_event)
+            attributes.append(attr)
+        return attributes
+
+
+class MockZmqPublisher:
+    """Stands in for the ZeroMQ feed of misp, publishing events and attributes like misp does."""
+
+    def __init__(self):
+        self.socket = None
+        self.port = None
+
+    def start(self):
+        import zmq
+
+        self.socket = zmq.Context.instance().socket(zmq.PUB)
+        self.port = self.socket.bind_to_random_port('tcp://127.0.0.1')
+        return self.url
+
+    def stop(self):
+        self.socket.close(linger=0)
+
+    @property
+    def url(self):
+        return f'tcp://127.0.0.1:{self.port}'
+
+    def publish_event(self, event):
+        self.socket.send_string(f'misp_json {json.dumps({"Event": event, "action": "publish"})}')
+
+    def publish_attribute(self, attr):
+        self.socket.send_string(f'misp_json_attribute {json.dumps({"Attribute": attr, "action": "add"})}')
@@ -0,0 +1,38 @@
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from RunReport import run_report
+from translation import parse_event_request_bodies
+
+
+def _parse_chunk(events):
+    # the worker's own report, its timings travel back with the results
+    run_report.reset()
+    return [parse_event_request_bodies(event) for event in events], run_report.get_stages()
+
+
+def parse_events_in_processes(events, workers, chunk_size):
+    """Parses events in a pool of worker processes, yielding results in input order.
+
+    Events are sent to the workers in chunks of chunk_size. At most two chunks
+    per worker are pending, so neither fetching nor parsing runs far ahead of
+    whoever consumes the results. The workers are started from a fork server,
+    a worker forked from this process could inherit a lock one of its threads
+    held at that moment and hang on it.
+    """
+    events = iter(events)
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver')) as executor:
+        while True:
+            while len(pending) < 2 * workers:
+                chunk = list(islice(events, chunk_size))
+                if not chunk:
+                    break
+                pending.append(executor.submit(_parse_chunk, chunk))
+            if not pending:
+                return
+            results, stages = pending.popleft().result()
+            run_report.add_stages(stages)
+            yield from results
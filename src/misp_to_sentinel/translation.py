@@ -0,0 +1,187 @@
+import datetime
+from collections import defaultdict
+
+import config
+from constants import *
+from fingerprint import VOLATILE_FIELDS, get_stable_fingerprint
+from RunReport import run_report
+
+GRAPH_FILE_HASH_TYPES = frozenset(['sha1', 'sha256', 'md5', 'authenticodeHash256', 'lsHash', 'ctph'])
+
+
+def _ip_field(ip, graph_v4_name, graph_v6_name):
+    return graph_v4_name if '.' in ip else graph_v6_name
+
+
+def _mapped_handler(graph_name):
+    def handle(value, indicator):
+        indicator[graph_name] = value
+    return handle
+
+
+def _ip_handler(graph_v4_name, graph_v6_name):
+    def handle(value, indicator):
+        indicator[_ip_field(value, graph_v4_name, graph_v6_name)] = value
+    return handle
+
+
+def _ip_port_handler(graph_v4_name, graph_v6_name, graph_port_name):
+    def handle(value, indicator):
+        ip, _, port = value.partition('|')
+        indicator[graph_port_name] = port
+        indicator[_ip_field(ip, graph_v4_name, graph_v6_name)] = ip
+    return handle
+
+
+def _file_hash_handler(hash_type):
+    graph_hash_type = hash_type if hash_type in GRAPH_FILE_HASH_TYPES else 'unknown'
+
+    def handle(value, indicator):
+        indicator['fileHashType'] = graph_hash_type
+        indicator['fileHashValue'] = value
+    return handle
+
+
+def _filename_hash_handler(hash_type):
+    graph_hash_type = hash_type if hash_type in GRAPH_FILE_HASH_TYPES else 'unknown'
+
+    def handle(value, indicator):
+        indicator['fileHashType'] = graph_hash_type
+        indicator['fileName'], _, indicator['fileHashValue'] = value.partition('|')
+    return handle
+
+
+def _handle_email_src(value, indicator):
+    indicator['emailSenderAddress'] = value
+    indicator['emailSourceDomain'] = value.partition('@')[2]
+
+
+def _handle_domain_ip(value, indicator):
+    domain, _, ip = value.partition('|')
+    indicator['domainName'] = domain
+    indicator[_ip_field(ip, 'networkIPv4', 'networkIPv6')] = ip
+
+
+def _build_translation_table():
+    table = {misp_type: _mapped_handler(graph_name) for misp_type, graph_name in ATTR_MAPPING.items()}
+    for misp_type in MISP_HASH_TYPES:
+        if misp_type.startswith('filename|'):
+            table[misp_type] = _filename_hash_handler(misp_type.split('|')[1])
+        else:
+            table[misp_type] = _file_hash_handler(misp_type)
+    table['ip-dst'] = _ip_handler('networkDestinationIPv4', 'networkDestinationIPv6')
+    table['ip-src'] = _ip_handler('networkSourceIPv4', 'networkSourceIPv6')
+    table['ip-dst|port'] = _ip_port_handler('networkDestinationIPv4', 'networkDestinationIPv6', 'networkDestinationPort')
+    table['ip-src|port'] = _ip_port_handler('networkSourceIPv4', 'networkSourceIPv6', 'networkSourcePort')
+    table['domain|ip'] = _handle_domain_ip
+    table['email-src'] = _handle_email_src
+    return table
+
+
+# one handler per actionable misp attribute type, resolved once at import
+TRANSLATION_TABLE = _build_translation_table()
+
+
+def translate_attribute(attr):
+    """Translates a misp attribute into the observable fields of a Graph tiIndicator.
+
+    Returns a dict with the observable fields, the attribute tags and the
+    diamond model phase if the attribute is tagged with one. The attribute
+    type and value come along as MISP_OBSERVABLE, what merging and in-place
+    updates recognize an indicator by.
+    """
+    indicator = {MISP_OBSERVABLE: (attr['type'], attr['value'])}
+    TRANSLATION_TABLE[attr['type']](attr['value'], indicator)
+    tags = [tag['name'].strip() for tag in attr.get('Tag', ())]
+    indicator['tags'] = tags
+    for tag in tags:
+        if 'diamond-model:' in tag:
+            indicator['diamondModel'] = tag.split(':')[1]
+    return indicator
+
+
+def graph_post_request_bodies(event):
+    """Yields the Graph tiIndicator request body of every indicator in a parsed event.
+
+    The event metadata is assembled once, each body is then a single dict
+    that already carries its fingerprint. Volatile fields and the misp
+    observable are added after fingerprinting so the fingerprint needs no
+    filtered copy of the body.
+    """
+    stable_metadata = {
+        **{field: event[field] for field in REQUIRED_GRAPH_METADATA if field not in VOLATILE_FIELDS},
+        **{field: event[field] for field in OPTIONAL_GRAPH_METADATA if field in event and field not in VOLATILE_FIELDS},
+        'action': config.action,
+        'passiveOnly': config.passiveOnly,
+        'threatType': 'watchlist',
+        'targetProduct': config.targetProduct,
+    }
+    volatile_metadata = {'lastReportedDateTime': event['lastReportedDateTime']} if 'lastReportedDateTime' in event else {}
+    event_tags = stable_metadata['tags']
+    for request_object in event['request_objects']:
+        request_body = {**stable_metadata, **request_object, 'tags': event_tags + request_object['tags']}
+        observable = request_body.pop(MISP_OBSERVABLE, None)
+        request_body[INDICATOR_REQUEST_HASH] = get_stable_fingerprint(request_body)
+        request_body.update(volatile_metadata)
+        if observable is not None:
+            request_body[MISP_OBSERVABLE] = observable
+        yield request_body
+
+
+def _handle_timestamp(parsed_event):
+    parsed_event['lastReportedDateTime'] = str(
+        datetime.datetime.fromtimestamp(int(parsed_event['lastReportedDateTime'])))
+
+
+def _handle_diamond_model(parsed_event):
+    for tag in parsed_event['tags']:
+        if 'diamond-model:' in tag:
+            parsed_event['diamondModel'] = tag.split(':')[1]
+
+
+def _handle_tlp_level(parsed_event):
+    for tag in parsed_event['tags']:
+        if 'tlp:' in tag:
+            tlpLevel = str(tag.split(':')[1]).lower()
+            if tlpLevel not in ['unknown','white','green','amber','red']:
+                continue
+            parsed_event['tlpLevel'] = tlpLevel
+
+    if 'tlpLevel' not in parsed_event:
+        parsed_event['tlpLevel'] = 'unknown'
+
+
+def parse_event(event):
+    parsed_event = defaultdict(list)
+    # feed and export events carry no local id, only their uuid
+    parsed_event['mispEventId'] = event.get('id') or event['uuid']
+    parsed_event['mispTimestamp'] = int(event['timestamp'])
+
+    for key, mapping in EVENT_MAPPING.items():
+        parsed_event[mapping] = event.get(key, "")
+    parsed_event['tags'] = [tag['name'].strip() for tag in event.get("Tag", [])]
+    _handle_diamond_model(parsed_event)
+    _handle_tlp_level(parsed_event)
+    _handle_timestamp(parsed_event)
+
+    for attr in event['Attribute']:
+        if attr.get('deleted'):
+            continue
+        if attr['type'] == 'threat-actor':
+            parsed_event['activityGroupNames'].append(attr['value'])
+        if attr['type'] == 'comment':
+            parsed_event['description'] += attr['value']
+        if attr['type'] in MISP_ACTIONABLE_TYPES:
+            parsed_event['request_objects'].append(translate_attribute(attr))
+
+    return parsed_event
+
+
+def parse_event_request_bodies(event):
+    """Parses a misp event into (event id, event timestamp, list of request bodies)."""
+    with run_report.time('parse'):
+        parsed_event = parse_event(event)
+    # assembling includes taking the fingerprints
+    with run_report.time('assemble'):
+        request_bodies = list(graph_post_request_bodies(parsed_event))
+    return parsed_event['mispEventId'], parsed_event['mispTimestamp'], request_bodies